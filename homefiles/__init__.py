@@ -1,9 +1,14 @@
 #!/usr/bin/env python
-import fnmatch
 import os
-import platform
-
-import git
+import re
+import stat
+
+import deploy
+import events
+import ignore
+import plan
+import profiling
+import template
 import utils
 
 
@@ -36,6 +41,55 @@ class NotASymlink(HomefilesException):
     pass
 
 
+class Conflicts(NotASymlink):
+    """Every path that is in the way, found before anything was changed."""
+    def __init__(self, conflicts):
+        self.paths = [op.path for op in conflicts]
+        reasons = [op.reason for op in conflicts]
+        if len(reasons) == 1:
+            message = reasons[0]
+        else:
+            message = '%d paths are in the way:\n  %s' % (
+                len(reasons), '\n  '.join(reasons))
+        super(Conflicts, self).__init__(message)
+
+
+class AlreadyTracked(HomefilesException):
+    pass
+
+
+class PathNotFound(HomefilesException):
+    pass
+
+
+class InvalidDeployRule(HomefilesException):
+    pass
+
+
+class InvalidTemplate(HomefilesException):
+    pass
+
+
+class OutsideRoot(HomefilesException):
+    pass
+
+
+class MissingGitConfig(HomefilesException):
+    pass
+
+
+class NoRemote(HomefilesException):
+    pass
+
+
+class GitCommandFailed(HomefilesException):
+    pass
+
+
+class FilesystemError(HomefilesException):
+    pass
+
+
 class CustomBundleState(object):
     """Records which custom bundles have been applied so that if we need to
     re-link during a `sync` operation, we'll know which bundles to re-apply.
@@ -66,39 +120,562 @@ class CustomBundleState(object):
                 f.write('%s\n' % bundle)
 
 
+def _in_root(path, root_path):
+    return path.startswith(root_path.rstrip('/') + '/')
+
+
+class LinkManifest(object):
+    """Records every symlink and directory created by `link`, per bundle, so
+    that `unlink` can remove exactly those entries without re-walking the
+    bundles.
+
+    Paths are absolute, so one manifest can hold the links of several roots;
+    `root_path` limits reads and writes to the entries under one of them.
+    """
+    def __init__(self, repo_path):
+        self.path = os.path.join(repo_path, '.git', 'homefiles-manifest')
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def read(self, root_path=None):
+        """Return a list of (bundle, kind, path) entries in the order they
+        were created.
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        entries = []
+        with open(self.path) as f:
+            for line in f:
+                bundle, kind, path = line.rstrip('\n').split('\t', 2)
+                if root_path is None or _in_root(path, root_path):
+                    entries.append((bundle, kind, path))
+
+        return entries
+
+    def write(self, entries, root_path=None):
+        if root_path is not None:
+            entries = [e for e in self.read()
+                       if not _in_root(e[2], root_path)] + list(entries)
+
+        with open(self.path, 'w') as f:
+            for bundle, kind, path in entries:
+                f.write('%s\t%s\t%s\n' % (bundle, kind, path))
+
+    def extend(self, entries):
+        existing = self.read()
+        kinds = dict((path, kind) for bundle, kind, path in existing)
+        added = []
+        replaced = {}
+        for bundle, kind, path in entries:
+            if path not in kinds:
+                added.append((bundle, kind, path))
+            elif kinds[path] != kind:
+                # e.g. a directory link that was split into a directory
+                replaced[path] = (bundle, kind, path)
+            kinds[path] = kind
+
+        if replaced:
+            self.write([replaced.get(entry[2], entry) for entry in existing] +
+                       added)
+            return
+
+        with open(self.path, 'a') as f:
+            for bundle, kind, path in added:
+                f.write('%s\t%s\t%s\n' % (bundle, kind, path))
+
+
+class LinkedCommitState(object):
+    """Records the commit that was last linked, and the bundles it was linked
+    from, so that `sync` can relink only the paths that changed since then
+    and `status` can tell when the manifest alone describes the root.
+    """
+    def __init__(self, repo_path):
+        self.path = os.path.join(repo_path, '.git', 'homefiles-linked-commit')
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _read_lines(self):
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path) as f:
+            return [line.strip() for line in f]
+
+    def read(self):
+        lines = self._read_lines()
+        return lines and lines[0] or None
+
+    def bundles(self):
+        """The bundles last linked, or None if they weren't recorded."""
+        lines = self._read_lines()
+        return lines[1:] or None
+
+    def write(self, commit, bundles=()):
+        with open(self.path, 'w') as f:
+            f.write('%s\n' % commit)
+            for bundle in bundles:
+                f.write('%s\n' % bundle)
+
+
+class PlatformState(object):
+    """Caches the detected platform bundles so that the release files under
+    /etc are only parsed again when one of them changes.
+    """
+    RELEASE_FILE_RE = re.compile(r'(\w+)[-_](release|version)')
+
+    def __init__(self, repo_path):
+        self.path = os.path.join(repo_path, '.git', 'homefiles-platform')
+
+    def key(self):
+        """The OS name plus the name and mtime of every release file
+        `platform.linux_distribution` could read.
+        """
+        parts = [os.uname()[0]]
+        try:
+            names = sorted(os.listdir('/etc'))
+        except OSError:
+            names = []
+
+        for name in names:
+            if self.RELEASE_FILE_RE.match(name):
+                path = os.path.join('/etc', name)
+                try:
+                    parts.append('%s:%r' % (path, os.stat(path).st_mtime))
+                except OSError:
+                    pass
+
+        return ';'.join(parts)
+
+    def read(self, key):
+        """Return the cached platforms if they were detected under `key`."""
+        if not os.path.exists(self.path):
+            return None
+
+        with open(self.path) as f:
+            lines = [line.rstrip('\n') for line in f]
+
+        if not lines or lines[0] != key:
+            return None
+
+        return lines[1:]
+
+    def write(self, key, platforms):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            return
+
+        with open(self.path, 'w') as f:
+            f.write('%s\n' % key)
+            for platform in platforms:
+                f.write('%s\n' % platform)
+
+
+class Status(object):
+    """How the root differs from what `link` would produce."""
+    def __init__(self):
+        self.missing = []
+        self.broken = []
+        self.wrong_target = []
+        self.blocked = []
+        # Copies and hard links that need deploying again or pulling back
+        self.outdated = []
+        self.uncommitted_changes = False
+        self.commits_ahead = None
+
+    @property
+    def consistent(self):
+        return not (self.missing or self.broken or self.wrong_target or
+                    self.blocked or self.outdated or
+                    self.uncommitted_changes or self.commits_ahead)
+
+    def describe(self):
+        lines = []
+        for path in self.missing:
+            lines.append("missing  '%s'" % path)
+        for path, target in self.broken:
+            lines.append("broken   '%s' -> '%s'" % (path, target))
+        for path, target, expected in self.wrong_target:
+            lines.append("wrong    '%s' -> '%s' (expected '%s')"
+                         % (path, target, expected))
+        for path in self.blocked:
+            lines.append("blocked  '%s'" % path)
+        for path, reason in self.outdated:
+            if reason:
+                lines.append("outdated '%s' (%s)" % (path, reason))
+            else:
+                lines.append("outdated '%s'" % path)
+        if self.uncommitted_changes:
+            lines.append('repo has uncommitted changes')
+        if self.commits_ahead:
+            lines.append('repo is %d commit(s) ahead of origin'
+                         % self.commits_ahead)
+        return lines
+
+
+class SparseCheckout(object):
+    """Which bundles are checked out of a repo cloned with `sparse`.
+
+    They are read from git's cone-mode sparse-checkout file, so only repos
+    that have one pay for asking git (`is_enabled`) whether it's in use.
+    """
+    def __init__(self, repo_path, is_enabled):
+        self.path = os.path.join(repo_path, '.git', 'info', 'sparse-checkout')
+        self._is_enabled = is_enabled
+        self._bundles = None
+        self._loaded = False
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+
+        cone = False
+        bundles = []
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if line == '!/*/':
+                    cone = True
+                elif line.startswith('/') and line.endswith('/') and \
+                        line.count('/') == 2:
+                    bundles.append(line[1:-1])
+
+        # git leaves the file behind when sparse checkout is turned off
+        if not cone or not self._is_enabled():
+            return None
+        return bundles
+
+    def invalidate(self):
+        self._bundles = None
+        self._loaded = False
+
+    def bundles(self):
+        """The checked-out bundles, or None if the whole repo is."""
+        if not self._loaded:
+            self._bundles = self._read()
+            self._loaded = True
+        return self._bundles
+
+
+class TrackedDirectoryIndex(object):
+    """Every directory in the repo holding a .trackeddir marker.
+
+    The index is built once, from `list_markers` (a single `git ls-files`) or
+    one walk of the repo if that returns None, so that checking whether a
+    directory is tracked is a prefix query with no filesystem calls.
+    """
+    def __init__(self, repo_path, list_markers):
+        self.repo_path = repo_path
+        self._list_markers = list_markers
+        self._directories = None
+
+    def _markers_from_walk(self):
+        markers = []
+        git_dir = os.path.join(self.repo_path, '.git')
+        for dirpath, dirnames, filenames in utils.walk(
+                self.repo_path, skip=lambda path, is_dir: path == git_dir):
+            if '.trackeddir' in filenames:
+                markers.append(utils.relpath(
+                    self.repo_path, os.path.join(dirpath, '.trackeddir')))
+        return markers
+
+    def _build(self):
+        markers = self._list_markers()
+        if markers is None:
+            markers = self._markers_from_walk()
+
+        return set(os.path.join(self.repo_path, os.path.dirname(marker))
+                   for marker in markers)
+
+    def invalidate(self):
+        self._directories = None
+
+    def is_tracked(self, path):
+        """A directory is tracked if it or one of its parents has a
+        .trackeddir marker file.
+        """
+        if self._directories is None:
+            self._directories = self._build()
+
+        if not self._directories:
+            return False
+
+        while len(path) > len(self.repo_path):
+            if path in self._directories:
+                return True
+            path = path[:path.rfind('/')]
+
+        return False
+
+
+class IndexTree(object):
+    """The repo's files as recorded in the git index, from a single
+    `git ls-files` call, arranged by directory so bundles can be listed
+    without walking whatever else is lying around in the working tree.
+    """
+    def __init__(self, repo_path, list_paths):
+        self.repo_path = repo_path
+        self._list_paths = list_paths
+        self._paths = None
+        self._directories = None
+
+    @property
+    def paths(self):
+        """Repo-relative paths of every file in the index."""
+        if self._paths is None:
+            self._paths = self._list_paths()
+        return self._paths
+
+    def _build(self):
+        # Repo-relative directory -> ([dirnames], [filenames])
+        directories = {'': ([], [])}
+
+        def add_directory(dirpath):
+            contents = directories[dirpath] = ([], [])
+            parent, name = os.path.split(dirpath)
+            parent_contents = directories.get(parent)
+            if parent_contents is None:
+                parent_contents = add_directory(parent)
+            parent_contents[0].append(name)
+            return contents
+
+        for path in self.paths:
+            dirpath, filename = os.path.split(path)
+            contents = directories.get(dirpath)
+            if contents is None:
+                contents = add_directory(dirpath)
+            contents[1].append(filename)
+
+        return directories
+
+    def invalidate(self):
+        self._paths = None
+        self._directories = None
+
+    def walk(self, top, skip=None, prune=None):
+        """Same as `utils.walk`, but over the index rather than the disk."""
+        if self._directories is None:
+            self._directories = self._build()
+
+        prefix_len = len(self.repo_path) + 1
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                subdirs, files = self._directories[dirpath[prefix_len:]]
+            except KeyError:
+                continue
+
+            dirnames = []
+            filenames = []
+            descend = []
+            for name in subdirs:
+                path = os.path.join(dirpath, name)
+                if skip is not None and skip(path, True):
+                    continue
+                dirnames.append(name)
+                if prune is None or not prune(path):
+                    descend.append(path)
+
+            for name in files:
+                if skip is not None and \
+                        skip(os.path.join(dirpath, name), False):
+                    continue
+                filenames.append(name)
+
+            yield dirpath, dirnames, filenames
+
+            stack.extend(reversed(descend))
+
+
+class OverlayNode(object):
+    """A root-relative path in the overlay and every bundle supplying it."""
+    def __init__(self, relpath):
+        self.relpath = relpath
+        # (kind, source, bundle) from most to least specific bundle
+        self.suppliers = []
+        self.children = {}
+
+    @property
+    def kind(self):
+        return self.suppliers[0][0]
+
+    @property
+    def source(self):
+        return self.suppliers[0][1]
+
+    @property
+    def bundle(self):
+        """The winning bundle."""
+        return self.suppliers[0][2]
+
+    @property
+    def shadowed(self):
+        """Suppliers that lose to the winner. Directories are merged rather
+        than shadowed, so they have none.
+        """
+        if self.kind == 'directory':
+            return []
+        return self.suppliers[1:]
+
+
+class Overlay(object):
+    """Bundles merged into one tree of root-relative paths, in which each
+    path knows the bundle it is linked from and the bundles it shadows.
+    """
+    def __init__(self, entries):
+        """`entries` are (kind, source, relpath, bundle) tuples ordered from
+        most to least specific bundle, as from `Homefiles._bundle_entries`.
+        """
+        self.top = OverlayNode('')
+        for kind, source, relpath, bundle in entries:
+            node = self.top
+            for name in relpath.split('/'):
+                child = node.children.get(name)
+                if child is None:
+                    child = node.children[name] = OverlayNode(
+                        os.path.join(node.relpath, name))
+                node = child
+            node.suppliers.append((kind, source, bundle))
+
+    def find(self, relpath):
+        """Return the node for `relpath`, or for the nearest parent in the
+        overlay if it lies beneath a linked directory; None otherwise.
+        """
+        node = self.top
+        for name in relpath.split('/'):
+            child = node.children.get(name)
+            if child is None:
+                return node if node.suppliers else None
+            node = child
+        return node
+
+    def nodes(self, winners_only=False):
+        """Yield every node, parents before children and siblings in name
+        order. With `winners_only`, skip what lies beneath a path whose
+        winner isn't a directory, since none of it can be linked.
+        """
+        stack = [self.top]
+        while stack:
+            node = stack.pop()
+            if node.suppliers:
+                yield node
+                if winners_only and node.kind != 'directory':
+                    continue
+            stack.extend(node.children[name]
+                         for name in sorted(node.children, reverse=True))
+
+    def entries(self):
+        """The winning (kind, source, relpath, bundle) for every path that
+        should appear in the root, parents before children.
+        """
+        for node in self.nodes(winners_only=True):
+            yield node.kind, node.source, node.relpath, node.bundle
+
+
 class Homefiles(object):
-    def __init__(self, root_path, repo_path, remote_repo, dry_run=False):
+    def __init__(self, root_path, repo_path, remote_repo, dry_run=False,
+                 collapse_directories=False, use_git_index=False):
         self.root_path = root_path
         self.repo_path = repo_path
         self.remote_repo = remote_repo
         self.dry_run = dry_run
-        self.git = git.GitRepo(repo_path, dry_run=self.dry_run)
-        self.tracked_directories = {}
+        self.collapse_directories = collapse_directories
+        self.use_git_index = use_git_index
+        self._git = None
+        self.index_tree = IndexTree(repo_path, self._index_paths)
+        self.tracked_directories = TrackedDirectoryIndex(
+            repo_path, self._tracked_directory_markers)
+        self.sparse_checkout = SparseCheckout(
+            repo_path, self._sparse_checkout_enabled)
         self.custom_bundle_state = CustomBundleState(repo_path)
+        self.manifest = LinkManifest(repo_path)
+        self.linked_commit_state = LinkedCommitState(repo_path)
+        self._ignore_rules = None
+        self._deploy_rules = None
+        self.hash_cache = deploy.HashCache(repo_path)
+        self.templates = template.TemplateRenderer(
+            repo_path, self.hash_cache, self._template_variables,
+            dry_run=dry_run)
+        # Bundle-relative directories holding ignored entries, from the last
+        # walk of each bundle
+        self._ignored_parents = {}
+        self.platform_state = PlatformState(repo_path)
+        self._platforms = None
+
+    @property
+    def git(self):
+        # Imported on first use so that read-only commands like `bundles`
+        # never load the git wrapper
+        if self._git is None:
+            import git
+            self._git = git.GitRepo(self.repo_path, dry_run=self.dry_run)
+        return self._git
+
+    def _index_paths(self):
+        paths = self.git.index_paths()
+        checked_out = self.sparse_checkout.bundles()
+        if checked_out is None:
+            return paths
+
+        # The index lists the files of bundles left out of a sparse checkout
+        # too
+        checked_out = set(checked_out)
+        return [path for path in paths
+                if '/' not in path or path.split('/', 1)[0] in checked_out]
+
+    def _invalidate_tree(self):
+        self.tracked_directories.invalidate()
+        self.index_tree.invalidate()
+        self.sparse_checkout.invalidate()
+
+    def _sparse_checkout_enabled(self):
+        import git
+        try:
+            return self.git.sparse_checkout_enabled()
+        except (git.GitException, git.ProcessException):
+            return False
+
+    def _check_out_bundles(self, bundles):
+        """Widen a sparse checkout to include `bundles`."""
+        checked_out = self.sparse_checkout.bundles()
+        if checked_out is None:
+            return
 
-    def _is_directory_tracked(self, path):
-        """A directory is tracked if it or one of its parents has a .trackeddir
-        marker file.
-        """
-        # TODO: this could be rewritten to not be recursive and instead use
-        # utils.parent_directories
+        missing = [b for b in bundles if b not in checked_out]
+        if missing:
+            self.git.sparse_checkout('add', *missing)
+            self._invalidate_tree()
+
+    def _tracked_directory_markers(self):
+        if self.use_git_index:
+            # Already listed along with everything else
+            return [path for path in self.index_tree.paths
+                    if os.path.basename(path) == '.trackeddir']
+
+        import git
         try:
-            return self.tracked_directories[path]
-        except KeyError:
-            pass
-
-        if os.path.exists(os.path.join(path, '.trackeddir')):
-            tracked = True
-        elif path == '/':
-            tracked = False
-        else:
-            tracked = self._is_directory_tracked(os.path.dirname(path))
+            markers = self.git.tracked_directory_markers()
+        except (git.GitException, git.ProcessException):
+            return None
 
-        self.tracked_directories[path] = tracked
-        return tracked
+        # Bundles are walked on disk, so markers count whether or not
+        # they're committed, but only while they're there
+        return [marker for marker in markers
+                if os.path.lexists(os.path.join(self.repo_path, marker))]
+
+    def _is_directory_tracked(self, path):
+        return self.tracked_directories.is_tracked(path)
 
     def _track_directory(self, path):
-        utils.log("Tracking directory '%s'" % path, newline=False)
+        utils.log("Tracking directory '%s'" % path, newline=False,
+                  op='track-directory', dst=path)
         marker = os.path.join(path, '.trackeddir')
         if not self.dry_run:
             with open(marker, 'w') as f:
@@ -110,6 +687,18 @@ class Homefiles(object):
         """Return platforms available for this machine going from most
         specific to least specific.
         """
+        if self._platforms is None:
+            key = self.platform_state.key()
+            self._platforms = self.platform_state.read(key)
+            if self._platforms is None:
+                self._platforms = self._detect_platforms()
+                if not self.dry_run:
+                    self.platform_state.write(key, self._platforms)
+        return list(self._platforms)
+
+    def _detect_platforms(self):
+        import platform
+
         platforms = []
         system = platform.system()
         if system:
@@ -130,12 +719,24 @@ class Homefiles(object):
         platforms.reverse()
         return ['OS-%s' % p for p in platforms]
 
+    def _template_variables(self):
+        return template.host_variables(self._matching_platforms())
+
     def _present_bundles(self):
-        return [b for b in os.listdir(self.repo_path) if b != '.git']
+        present = [b for b in os.listdir(self.repo_path)
+                   if b not in ('.git', ignore.IGNORE_FILENAME,
+                                deploy.DEPLOY_FILENAME,
+                                template.VARS_FILENAME)]
+        if self.sparse_checkout.bundles() is not None:
+            # Bundles left out of a sparse checkout are only in git's tree
+            present.extend(b for b in self.git.top_level_directories()
+                           if b not in present)
+        return present
 
     def _is_custom_bundle(self, bundle):
         return bundle != 'Default' and not bundle.startswith('OS-')
 
+    @profiling.timed('bundle selection')
     def _selected_bundles(self, selected):
         """Return an ordered list of bundles from most-specific to
         least-specific that match the selected criteria.
@@ -163,6 +764,7 @@ class Homefiles(object):
 
         return ordered_matches
 
+    @profiling.timed('bundle selection')
     def bundle_breakdown(self):
         default = set(['Default'])
         platform = set(self._matching_platforms())
@@ -175,143 +777,664 @@ class Homefiles(object):
         return matching, non_matching
 
     def _walk_bundle(self, bundle):
+        """Yield (dirpath, dirnames, filenames, relpath) for each untracked
+        directory in a bundle.
+
+        Ignored names never appear in the results, and tracked directories
+        are listed in their parent's dirnames but never descended into. With
+        `use_git_index` only files in the git index are listed.
+        """
         bundle_path = os.path.join(self.repo_path, bundle)
         if not os.path.exists(bundle_path):
             return
 
-        for dirpath, dirnames, filenames in os.walk(bundle_path):
-            if self._is_directory_tracked(dirpath):
-                continue
+        if self._is_directory_tracked(bundle_path):
+            return
+
+        ignore_rules = self.ignore_rules
+        prefix_len = len(bundle_path) + 1
+        ignored_parents = self._ignored_parents[bundle] = set()
+
+        def skip(path, is_dir):
+            relpath = path[prefix_len:]
+            if ignore_rules.match(relpath, is_dir=is_dir):
+                ignored_parents.add(os.path.dirname(relpath))
+                return True
+            return False
 
+        if self.use_git_index:
+            walk = self.index_tree.walk
+        else:
+            walk = utils.walk
+
+        for dirpath, dirnames, filenames in walk(
+                bundle_path, skip=skip, prune=self._is_directory_tracked):
             relpath = utils.relpath(bundle_path, dirpath)
             yield dirpath, dirnames, filenames, relpath
 
-    def _link_bundle(self, bundle, undo_log):
-        utils.log("Linking bundle '%s'" % bundle)
+    def _bundle_entries(self, bundle, render=True):
+        """Yield a (kind, source, relpath, bundle) tuple for everything in
+        the bundle that should appear in the root, parents before children.
 
+        Without `render`, templates are not rendered and their source is
+        where the output would be.
+        """
+        deploy_rules = self.deploy_rules
         for dirpath, dirnames, filenames, relpath in \
                 self._walk_bundle(bundle):
 
             for dirname in dirnames:
-                if self._ignore_match(dirname):
-                    continue
                 src_dirpath = os.path.join(dirpath, dirname)
-                dst_dirpath = os.path.join(self.root_path, relpath, dirname)
                 if self._is_directory_tracked(src_dirpath):
-                    utils.symlink(src_dirpath, dst_dirpath,
-                                  dry_run=self.dry_run, undo_log=undo_log)
+                    kind = 'symlink'
                 else:
-                    utils.mkdir(dst_dirpath, dry_run=self.dry_run,
-                                undo_log=undo_log)
+                    kind = 'directory'
+                yield (kind, src_dirpath, os.path.join(relpath, dirname),
+                       bundle)
 
             for filename in filenames:
-                if self._ignore_match(filename):
+                src_path = os.path.join(dirpath, filename)
+                file_relpath = os.path.join(relpath, filename)
+                if not filename.endswith(template.TEMPLATE_SUFFIX):
+                    yield (deploy_rules.mode(file_relpath), src_path,
+                           file_relpath, bundle)
                     continue
-                src_filename = os.path.join(dirpath, filename)
-                dst_filename = os.path.join(self.root_path, relpath, filename)
-                utils.symlink(src_filename, dst_filename,
-                              dry_run=self.dry_run, undo_log=undo_log)
 
-    def link(self, selected=None):
-        undo_log = []
-        for bundle in self._selected_bundles(selected):
-            try:
-                self._link_bundle(bundle, undo_log)
-            except utils.NotASymlink as e:
-                utils.undo_operations(undo_log)
-                raise NotASymlink(str(e))
-            except:
-                utils.undo_operations(undo_log)
-                raise
-            else:
-                if self._is_custom_bundle(bundle):
-                    self.custom_bundle_state.append(bundle)
+                # Rendered files are always symlinked, as edits made
+                # through them couldn't be pulled back into the template
+                file_relpath = file_relpath[:-len(template.TEMPLATE_SUFFIX)]
+                if render:
+                    output = self._render_template(src_path, bundle,
+                                                   file_relpath)
+                else:
+                    output = self.templates.output_path(bundle, file_relpath)
+                yield ('symlink', output, file_relpath, bundle)
 
-    def _ignore_match(self, filename):
-        for pattern in IGNORE:
-            print filename, pattern
-            if fnmatch.fnmatch(filename, pattern):
+    def _render_template(self, template_path, bundle, relpath):
+        try:
+            return self.templates.render(template_path, bundle, relpath)
+        except template.TemplateError as e:
+            raise InvalidTemplate(str(e))
+
+    def _apply_plan(self, pending, undo_log, label):
+        """Apply a plan, or just print it during a dry-run."""
+        if self.dry_run and events.ENABLED:
+            for op in pending.ordered():
+                events.emit('plan', op=op.kind, src=op.source, dst=op.path,
+                            bundle=op.bundle, reason=op.reason)
+            return
+
+        if self.dry_run:
+            for line in pending.describe():
+                print line
+            return
+
+        try:
+            plan.apply(pending, undo_log=undo_log, label=label)
+        except utils.NotASymlink as e:
+            utils.undo_operations(undo_log)
+            raise NotASymlink(str(e))
+        except:
+            utils.undo_operations(undo_log)
+            raise
+
+        self._record_deployed(pending)
+
+    def _record_deployed(self, pending):
+        """Remember what was deployed to copies and hard links so that the
+        next run can tell which side changed.
+        """
+        hashes = self.hash_cache
+        for op in pending:
+            if op.kind in (plan.COPY, plan.HARDLINK):
+                digest = hashes.digest(op.source)
+                hashes.record(op.path, os.lstat(op.path), digest)
+                hashes.set_deployed(op.path, digest)
+            elif op.kind == plan.PULL:
+                digest = hashes.digest(op.path)
+                hashes.record(op.source, os.lstat(op.source), digest)
+                hashes.set_deployed(op.path, digest)
+            elif op.kind == plan.SKIP and \
+                    op.existing in (plan.COPY, plan.HARDLINK):
+                hashes.set_deployed(op.path, hashes.digest(op.source))
+            elif op.kind == plan.DELETE:
+                hashes.forget_deployed(op.path)
+
+    def _manifest_entries(self, pending):
+        """Entries `unlink` should remove once `pending` has been applied."""
+        entries = []
+        for op in pending.ordered():
+            if op.kind in (plan.SYMLINK, plan.REPLACE):
+                entries.append((op.bundle, 'symlink', op.path))
+            elif op.kind == plan.MKDIR:
+                entries.append((op.bundle, 'directory', op.path))
+            elif op.kind == plan.SKIP and op.existing == 'symlink':
+                entries.append((op.bundle, 'symlink', op.path))
+            elif op.kind in (plan.COPY, plan.HARDLINK):
+                entries.append((op.bundle, op.kind, op.path))
+            elif op.kind in (plan.PULL, plan.SKIP) and \
+                    op.existing in (plan.COPY, plan.HARDLINK):
+                entries.append((op.bundle, op.existing, op.path))
+        return entries
+
+    def _overlay(self, bundles, render=True):
+        """Merge `bundles`, ordered from most to least specific, into one
+        `Overlay`.
+        """
+        entries = []
+        for bundle in bundles:
+            utils.log("Planning bundle '%s'" % bundle)
+            with profiling.phase("walk '%s'" % bundle):
+                entries.extend(self._bundle_entries(bundle, render=render))
+
+        with profiling.phase('merge bundles'):
+            return Overlay(entries)
+
+    def _link_entries(self, bundles):
+        return list(self._overlay(bundles).entries())
+
+    def _can_collapse(self, dst_path, root_path):
+        if utils.lstat(dst_path) is None or self._links_into_repo(dst_path):
+            return True
+
+        # Seen through a directory link that is about to be split
+        dirpath = os.path.dirname(dst_path)
+        while dirpath.startswith(root_path + '/'):
+            if self._links_into_repo(dirpath):
                 return True
+            dirpath = os.path.dirname(dirpath)
         return False
 
-    def _unlink_bundle(self, bundle, undo_log):
-        utils.log("Unlinking bundle '%s'" % bundle)
+    def _collapse_entries(self, entries, root_path):
+        """Replace each untracked directory that only one bundle supplies
+        with a single link to it, dropping the entries beneath it.
 
-        for dirpath, dirnames, filenames, relpath in \
-                self._walk_bundle(bundle):
+        Directories that already exist for real in the root, that hold
+        ignored entries a link would expose, or that hold copies, hard links
+        or rendered templates, keep their per-file links.
+        """
+        owners = {}
+        # Directories holding files that aren't plain links into the bundle,
+        # which a link would hide
+        deployed_parents = set()
+        for kind, source, relpath, bundle in entries:
+            path = relpath
+            while path:
+                owners.setdefault(path, set()).add(bundle)
+                path = os.path.dirname(path)
+            if kind in (plan.COPY, plan.HARDLINK) or \
+                    self.templates.is_rendered(source):
+                path = os.path.dirname(relpath)
+                while path and path not in deployed_parents:
+                    deployed_parents.add(path)
+                    path = os.path.dirname(path)
+
+        blocked = {}
+        for bundle, ignored_parents in self._ignored_parents.items():
+            bundle_blocked = blocked[bundle] = set()
+            for path in ignored_parents:
+                while path and path not in bundle_blocked:
+                    bundle_blocked.add(path)
+                    path = os.path.dirname(path)
+
+        collapsed = set()
+        result = []
+        for entry in entries:
+            kind, source, relpath, bundle = entry
+
+            parent = os.path.dirname(relpath)
+            while parent and parent not in collapsed:
+                parent = os.path.dirname(parent)
+            if parent:
+                continue
 
-            for filename in filenames:
-                if self._ignore_match(filename):
-                    continue
-                file_path = os.path.join(self.root_path, relpath, filename)
-                utils.remove_symlink(file_path, dry_run=self.dry_run,
-                                     undo_log=undo_log)
+            if kind == 'directory' and len(owners[relpath]) == 1 and \
+                    relpath not in blocked.get(bundle, ()) and \
+                    relpath not in deployed_parents and \
+                    self._can_collapse(os.path.join(root_path, relpath),
+                                       root_path):
+                collapsed.add(relpath)
+                entry = ('symlink', source, relpath, bundle)
+            result.append(entry)
+
+        return result
+
+    def _plan_root_link(self, entries, root_path):
+        with profiling.phase('plan link'):
+            if self.collapse_directories:
+                entries = self._collapse_entries(entries, root_path)
+            return plan.plan_link(entries, root_path,
+                                  repo_path=self.repo_path,
+                                  hashes=self.hash_cache)
+
+    def overlay(self, selected=None):
+        """The `Overlay` of the selected bundles, or of those currently
+        linked if none are selected.
+        """
+        if selected is None:
+            selected = self._relinkable_bundles()
+        return self._overlay(self._selected_bundles(selected))
 
-            for dirname in dirnames:
-                if self._ignore_match(dirname):
-                    continue
-                src_dirpath = os.path.join(dirpath, dirname)
-                dst_dirpath = os.path.join(self.root_path, relpath, dirname)
-                if self._is_directory_tracked(src_dirpath):
-                    utils.remove_symlink(dst_dirpath, dry_run=self.dry_run,
-                                         undo_log=undo_log)
+    def which(self, paths, selected=None):
+        """Return the overlay node supplying each of `paths` in the root.
 
-    def unlink(self, clear_custom_bundle_state=True):
+        That is the node of a linked parent directory for a path beneath
+        one, or None for a path no bundle supplies.
+        """
+        overlay = self.overlay(selected)
+        nodes = []
+        for path in paths:
+            relpath = utils.relpath(self.root_path, utils.truepath(path))
+            node = overlay.find(relpath)
+            if node is not None and node.relpath != relpath and \
+                    node.kind == 'directory':
+                node = None
+            nodes.append(node)
+        return nodes
+
+    def plan_link(self, selected=None):
+        bundles = self._selected_bundles(selected)
+        entries = self._link_entries(bundles)
+        return bundles, self._plan_root_link(entries, self.root_path)
+
+    def _back_up_conflicts(self, conflicts, root_path, backup_path,
+                           undo_log):
+        backup_plan = plan.plan_backup([op.path for op in conflicts],
+                                       root_path, backup_path)
+        if backup_plan.conflicts:
+            raise Conflicts(backup_plan.conflicts)
+
+        utils.log('Backing up %d paths to %s' % (len(conflicts), backup_path))
+        self._apply_plan(backup_plan, undo_log, 'backup')
+
+    def _link_root(self, entries, root_path, backup_path=None):
+        link_plan = self._plan_root_link(entries, root_path)
         undo_log = []
-        matching, non_matching = self.bundle_breakdown()
-        for bundle in sorted(matching | non_matching):
-            try:
-                self._unlink_bundle(bundle, undo_log)
-            except utils.NotASymlink as e:
-                utils.undo_operations(undo_log)
-                raise NotASymlink(str(e))
-            except:
+
+        if link_plan.conflicts and backup_path:
+            self._back_up_conflicts(link_plan.conflicts, root_path,
+                                    backup_path, undo_log)
+            if self.dry_run:
+                # Nothing was moved, so the plan can't be made again
+                self._apply_plan(link_plan, undo_log, 'link')
+                return []
+            link_plan = self._plan_root_link(entries, root_path)
+
+        # Refuse before anything is touched rather than rolling back, and
+        # name every path in the way so they can be dealt with in one go
+        if link_plan.conflicts:
+            if undo_log:
                 utils.undo_operations(undo_log)
-                raise
+            raise Conflicts(link_plan.conflicts)
 
-        if clear_custom_bundle_state:
+        self._apply_plan(link_plan, undo_log, 'link')
+        return self._manifest_entries(link_plan)
+
+    def _for_each_root(self, root_paths, func, jobs=None):
+        """Call `func(root_path)` for every root on a thread pool.
+
+        Returns a list of (root_path, result, error) in the order given,
+        where error is the exception that failed that root, or None.
+        """
+        def run(root_path):
+            try:
+                return root_path, func(root_path), None
+            except (HomefilesException, EnvironmentError) as e:
+                return root_path, None, e
+
+        # A dry-run prints each root's plan, so keep them in order
+        if self.dry_run:
+            jobs = 1
+        jobs = min(jobs or 8, len(root_paths))
+
+        if jobs <= 1:
+            return [run(root_path) for root_path in root_paths]
+
+        # Imported here so that commands working on one root never load
+        # multiprocessing
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        try:
+            return pool.map(run, root_paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    @utils.cache_stats
+    def link(self, selected=None, roots=None, jobs=None, backup_path=None):
+        """Link the selected bundles into the root.
+
+        Nothing is changed if anything is in the way; every such path is
+        named in the `Conflicts` raised. With `backup_path` they are moved
+        there instead, keeping their layout, and linking goes ahead.
+
+        With `roots`, the bundles are walked once and linked into each of
+        those roots in parallel instead. A root that fails is rolled back on
+        its own without affecting the others, and a list of
+        (root_path, error) is returned with error None for the roots that
+        were linked. Each root is backed up into its own directory beneath
+        `backup_path`.
+        """
+        bundles = self._selected_bundles(selected)
+        self._check_out_bundles(bundles)
+        entries = self._link_entries(bundles)
+
+        if roots is None:
+            results = [(self.root_path,
+                        self._link_root(entries, self.root_path,
+                                        backup_path=backup_path), None)]
+        else:
+            def link_root(root_path):
+                root_backup_path = backup_path and os.path.join(
+                    backup_path, root_path.lstrip('/'))
+                return self._link_root(entries, root_path,
+                                       backup_path=root_backup_path)
+
+            results = self._for_each_root(roots, link_root, jobs=jobs)
+            if all(error for root_path, result, error in results):
+                return [(root_path, error)
+                        for root_path, result, error in results]
+
+        for bundle in bundles:
+            if self._is_custom_bundle(bundle):
+                self.custom_bundle_state.append(bundle)
+
+        if not self.dry_run:
+            manifest_entries = []
+            for root_path, result, error in results:
+                if error is None:
+                    manifest_entries.extend(result)
+            self.manifest.extend(manifest_entries)
+            self.templates.save()
+            self.hash_cache.save()
+            self._record_linked_commit()
+
+        if roots is not None:
+            return [(root_path, error)
+                    for root_path, result, error in results]
+
+    def _linked_bundles(self):
+        """The bundles `sync` and `status` consider linked."""
+        return self._selected_bundles(self._relinkable_bundles())
+
+    def _record_linked_commit(self, commit=None):
+        commit = commit or self.git.head_commit()
+        if commit:
+            self.linked_commit_state.write(commit, self._linked_bundles())
+
+    @property
+    def deploy_rules(self):
+        """How files are put in place, from the repo's .homefilesdeploy."""
+        if self._deploy_rules is None:
+            try:
+                self._deploy_rules = deploy.DeployRules.from_repo(
+                    self.repo_path)
+            except deploy.InvalidDeployRule as e:
+                raise InvalidDeployRule(str(e))
+        return self._deploy_rules
+
+    @property
+    def ignore_rules(self):
+        """Compiled IGNORE defaults plus the repo's .homefilesignore."""
+        if self._ignore_rules is None:
+            self._ignore_rules = ignore.IgnoreRules.from_repo(
+                self.repo_path, defaults=IGNORE)
+        return self._ignore_rules
+
+    def _manifest_is_current(self, entries):
+        """Whether the manifest's `entries` are all that `link` would make,
+        since nothing was committed and no bundle selected since the last
+        link, and nothing is deployed by copying.
+        """
+        if not entries or self.deploy_rules.rules:
+            return False
+
+        commit = self.linked_commit_state.read()
+        if commit is None or \
+                self.linked_commit_state.bundles() != self._linked_bundles():
+            return False
+
+        return commit == self.git.head_commit()
+
+    def _check_manifest(self, entries, status, uncommitted):
+        """Check each link and directory `link` recorded, with an `lstat`
+        and for links a `readlink`.
+
+        A link pointing where it should can only be broken by deleting its
+        source, which `uncommitted` (from `git diff-index`) lists, so only
+        links pointing elsewhere need a `stat` as well.
+        """
+        deleted = set()
+        for path, change in uncommitted.items():
+            if change == 'D':
+                while path:
+                    deleted.add(path)
+                    path = os.path.dirname(path)
+
+        # Plain os calls, since each path is looked at once and this is
+        # cheap enough for a shell prompt only while it stays a couple of
+        # syscalls per entry
+        prefix_len = len(self.root_path) + 1
+        for bundle, kind, path in entries:
+            profiling.count('stat')
+            try:
+                st = os.lstat(path)
+            except OSError:
+                status.missing.append(path)
+                continue
+
+            if kind == 'directory':
+                if not stat.S_ISDIR(st.st_mode):
+                    status.blocked.append(path)
+                continue
+
+            if not stat.S_ISLNK(st.st_mode):
+                status.blocked.append(path)
+                continue
+
+            relpath = path[prefix_len:]
+            expected = os.path.join(self.repo_path, bundle, relpath)
+            target = os.readlink(path)
+            if target == expected:
+                if '%s/%s' % (bundle, relpath) not in deleted:
+                    continue
+            elif target != self.templates.output_path(bundle, relpath):
+                status.wrong_target.append((path, target, expected))
+
+            if not os.path.exists(path):
+                status.broken.append((path, target))
+
+    def _check_plan(self, status):
+        bundles, link_plan = self.plan_link(
+            selected=self._relinkable_bundles())
+
+        for op in link_plan:
+            if op.kind in (plan.SYMLINK, plan.COPY, plan.HARDLINK) and \
+                    not utils.lexists(op.path):
+                status.missing.append(op.path)
+            elif op.kind in (plan.COPY, plan.HARDLINK, plan.PULL):
+                status.outdated.append((op.path, op.reason))
+            elif op.kind == plan.CONFLICT:
+                status.blocked.append(op.path)
+            elif op.kind == plan.REPLACE:
+                status.wrong_target.append(
+                    (op.path, os.readlink(op.path), op.source))
+            elif op.kind == plan.SKIP and op.existing == 'symlink':
+                target = os.readlink(op.path)
+                if target != op.source:
+                    status.wrong_target.append((op.path, target, op.source))
+
+    @utils.cache_stats
+    def status(self):
+        """Compare the root against what `link` would produce for the
+        bundles currently linked, without changing anything.
+
+        While HEAD and the selected bundles are those last linked, only the
+        manifest's entries are checked rather than planning a link.
+        """
+        status = Status()
+        uncommitted = self.git.uncommitted_paths()
+        status.uncommitted_changes = bool(uncommitted)
+
+        entries = self.manifest.read(self.root_path)
+        if self._manifest_is_current(entries):
+            self._check_manifest(entries, status, uncommitted)
+        else:
+            self._check_plan(status)
+            for bundle, kind, path in entries:
+                if kind == 'symlink' and utils.islink(path) and \
+                        not os.path.exists(path):
+                    status.broken.append((path, os.readlink(path)))
+
+        status.commits_ahead = self.git.commits_ahead()
+        return status
+
+    def _walked_links(self, root_path=None):
+        """Every link any bundle could have made; the fallback for repos
+        linked before the manifest existed.
+        """
+        root_path = root_path or self.root_path
+        matching, non_matching = self.bundle_breakdown()
+        # Other hosts' templates may use variables this host doesn't set,
+        # and only where their output would be is needed here
+        overlay = self._overlay(sorted(matching | non_matching),
+                                render=False)
+        entries = []
+        for node in overlay.nodes():
+            for kind, source, bundle in node.suppliers:
+                if kind == 'symlink':
+                    entries.append((bundle, kind,
+                                    os.path.join(root_path, node.relpath)))
+                    break
+        return entries
+
+    def plan_unlink(self, root_path=None):
+        root_path = root_path or self.root_path
+        if self.manifest.exists():
+            # Newest first, so links go before the directories holding them
+            entries = list(reversed(self.manifest.read(root_path)))
+        else:
+            with profiling.phase('walk all bundles'):
+                entries = self._walked_links(root_path)
+
+        with profiling.phase('plan unlink'):
+            return plan.plan_unlink(entries, hashes=self.hash_cache)
+
+    def _unlink_root(self, root_path):
+        unlink_plan = self.plan_unlink(root_path)
+        if unlink_plan.conflicts:
+            raise Conflicts(unlink_plan.conflicts)
+
+        self._apply_plan(unlink_plan, [], 'unlink')
+
+    @utils.cache_stats
+    def unlink(self, clear_custom_bundle_state=True, roots=None, jobs=None):
+        """Remove the links `link` made in the root.
+
+        `roots` and `jobs` work as for `link`, returning a list of
+        (root_path, error).
+        """
+        if roots is None:
+            self._unlink_root(self.root_path)
+            results = [(self.root_path, None, None)]
+        else:
+            results = self._for_each_root(roots, self._unlink_root,
+                                          jobs=jobs)
+
+        if not self.dry_run:
+            for root_path, result, error in results:
+                if error is None:
+                    self.manifest.write([], root_path=root_path)
+            self.hash_cache.save()
+
+            # Other roots may still be linked from this repo
+            if not self.manifest.read():
+                self.manifest.clear()
+                self.linked_commit_state.clear()
+
+        if clear_custom_bundle_state and not self.manifest.exists():
             self.custom_bundle_state.clear()
 
-    def track(self, path, bundle=None):
-        """Track a file or a directory."""
+        if roots is not None:
+            return [(root_path, error)
+                    for root_path, result, error in results]
+
+    def _expand_track_paths(self, paths):
+        """Expand globs in `paths` and drop paths inside another one being
+        tracked, since they move along with it.
+        """
+        import glob
+
+        expanded = []
+        for path in paths:
+            pattern = os.path.expanduser(path)
+            if glob.has_magic(pattern):
+                # Links a glob picks up are most likely already tracked
+                matches = [m for m in sorted(glob.glob(pattern))
+                           if not self._links_into_repo(utils.truepath(m))]
+                if not matches:
+                    raise PathNotFound("No paths match '%s'" % path)
+            else:
+                matches = [pattern]
+
+            for match in matches:
+                src_path = utils.truepath(match)
+                if src_path not in expanded:
+                    expanded.append(src_path)
+
+        return [p for p in expanded
+                if not any(p.startswith(other + '/') for other in expanded)]
+
+    @utils.cache_stats
+    def track(self, paths, bundle=None):
+        """Track files and directories.
+
+        `paths` is a path or a list of paths and glob patterns; they are all
+        moved and linked as one batch, rolled back together, and committed
+        in a single commit.
+        """
         # We don't use kwarg default, because None represents default to
         # callers
         bundle = bundle or 'Default'
-        src_path = utils.truepath(path)
-        is_directory = os.path.isdir(src_path)
-
-        if self.root_path not in src_path:
-            raise Exception('Cannot track files outside of root path')
+        if isinstance(paths, basestring):
+            paths = [paths]
 
+        self._check_out_bundles([bundle])
         bundle_path = os.path.join(self.repo_path, bundle)
-        dst_path = os.path.join(
-            bundle_path, utils.relpath(self.root_path, src_path))
+        moves = []
+        directories = []
+        for src_path in self._expand_track_paths(paths):
+            if self.root_path not in src_path:
+                raise OutsideRoot('Cannot track files outside of root path')
 
-        undo_log = []
+            dst_path = os.path.join(
+                bundle_path, utils.relpath(self.root_path, src_path))
+            moves.append((src_path, dst_path, bundle))
+            if os.path.isdir(src_path):
+                directories.append(dst_path)
 
-        dst_dir = os.path.dirname(dst_path)
-        if not os.path.exists(dst_dir):
-            utils.makedirs(dst_dir, dry_run=self.dry_run, undo_log=undo_log)
+        track_plan = plan.plan_track(moves)
+        if track_plan.conflicts:
+            raise AlreadyTracked(track_plan.conflicts[0].reason)
 
-        try:
-            utils.rename(src_path, dst_path, dry_run=self.dry_run,
-                         undo_log=undo_log)
-            try:
-                utils.symlink(dst_path, src_path, dry_run=self.dry_run)
-            except:
-                utils.undo_operations(undo_log)
-                raise
-        except:
-            utils.undo_operations(undo_log)
-            raise
+        self._apply_plan(track_plan, [], 'track')
 
-        self.git.add(dst_path)
+        if not self.dry_run:
+            self.manifest.extend([(bundle, 'symlink', src_path)
+                                  for src_path, dst_path, bundle in moves])
 
-        if is_directory:
-            marker = self._track_directory(dst_path)
-            self.git.add(marker)
+        added = [dst_path for src_path, dst_path, bundle in moves]
+        for dst_path in directories:
+            added.append(self._track_directory(dst_path))
 
-        self.git.commit(message="Tracking '%s'" % path)
+        self.git.add(*added)
+        self._invalidate_tree()
+
+        if len(paths) == 1 and len(moves) == 1:
+            message = "Tracking '%s'" % paths[0]
+        else:
+            message = 'Tracking %d paths' % len(moves)
+        self.git.commit(message=message)
 
     def _populate_local_gitconfig(self, config):
         """If local gitconfig is empty populate it from global gitconfig."""
@@ -330,46 +1453,427 @@ class Homefiles(object):
             config, global_=True, ret_codes=[0, 1])[0].strip()
 
         if not global_config:
-            raise Exception("Unable to find '%s' in global gitconfig" %
-                            config)
+            raise MissingGitConfig("Unable to find '%s' in global gitconfig"
+                                   % config)
 
         # Set local to global
         self.git.config(config, global_config)
 
-    def _relink(self):
+    def _relinkable_bundles(self):
         # Bundles may have been removed, so only relink bundles that still
         # exist
-        custom_bundles = [b for b in self.custom_bundle_state.read() if
-                          os.path.exists(os.path.join(self.repo_path, b))]
+        return [b for b in self.custom_bundle_state.read() if
+                os.path.exists(os.path.join(self.repo_path, b))]
 
+    def _linked_entries(self):
+        """What is linked right now: the manifest, or for repos linked
+        before it existed, every link a bundle could have made.
+        """
+        if self.manifest.exists():
+            return self.manifest.read(self.root_path)
+        return self._walked_links()
+
+    def _links_into_repo(self, path):
+        return utils.islink(path) and \
+            os.readlink(path).startswith(self.repo_path + '/')
+
+    @utils.cache_stats
+    @profiling.timed('reconcile')
+    def _reconcile(self, linked):
+        """Bring the root in line with the current tree without an unlink
+        phase: only links that are no longer wanted are removed, links that
+        now point at the wrong source are retargeted in place, and
+        everything else is left alone.
+
+        `linked` is the (bundle, kind, path) list of what was linked before
+        the tree changed.
+        """
+        custom_bundles = self._relinkable_bundles()
         utils.log('Relinking custom bundles: %s' % custom_bundles)
-        self.link(selected=custom_bundles)
+        bundles = self._selected_bundles(custom_bundles)
+        entries = self._link_entries(bundles)
+        if self.collapse_directories:
+            entries = self._collapse_entries(entries, self.root_path)
+
+        desired = {}
+        for kind, source, relpath, bundle in entries:
+            desired.setdefault(os.path.join(self.root_path, relpath),
+                               (kind, source))
+
+        stale = []
+        for bundle, kind, path in linked:
+            wanted = desired.get(path)
+            if kind == 'symlink':
+                if not self._links_into_repo(path):
+                    continue
+                if wanted is None or wanted[0] != 'symlink':
+                    stale.append((bundle, kind, path))
+            elif kind in ('directory', plan.COPY, plan.HARDLINK):
+                if wanted is None or wanted[0] != kind:
+                    stale.append((bundle, kind, path))
+
+        undo_log = []
+        self._apply_plan(plan.plan_unlink(reversed(stale),
+                                          hashes=self.hash_cache),
+                         undo_log, 'unlink')
+
+        link_plan = plan.plan_link(entries, self.root_path,
+                                   repo_path=self.repo_path,
+                                   hashes=self.hash_cache)
+        if link_plan.conflicts:
+            if not self.dry_run:
+                utils.undo_operations(undo_log)
+            raise Conflicts(link_plan.conflicts)
+
+        self._apply_plan(link_plan, undo_log, 'link')
+
+        if not self.dry_run:
+            # Directories created by an earlier link that are still wanted
+            # stay ours even though this plan only skipped them
+            stale_paths = set(path for bundle, kind, path in stale)
+            manifest_entries = self._manifest_entries(link_plan)
+            recorded = set(path for bundle, kind, path in manifest_entries)
+            for bundle, kind, path in linked:
+                if kind == 'directory' and path not in stale_paths and \
+                        path not in recorded:
+                    manifest_entries.append((bundle, kind, path))
+                    recorded.add(path)
+
+            manifest_entries.sort(key=lambda entry: entry[2].split('/'))
+            self.manifest.write(manifest_entries, root_path=self.root_path)
+            self.templates.save()
+            self.hash_cache.save()
+            self._record_linked_commit()
+
+    def _touches_collapsed(self, paths):
+        """Whether any repo-relative path lies beneath a directory link, or
+        would start a new directory that might be collapsed.
+        """
+        for path in paths:
+            bundle, relpath = self._split_repo_path(path)
+            dst_dirpath = os.path.dirname(os.path.join(self.root_path,
+                                                       relpath))
+            if not utils.lexists(dst_dirpath):
+                return True
+            while dst_dirpath.startswith(self.root_path + '/'):
+                if self._links_into_repo(dst_dirpath):
+                    return True
+                dst_dirpath = os.path.dirname(dst_dirpath)
+        return False
+
+    def _split_repo_path(self, path):
+        """Split a repo-relative path into (bundle, bundle-relative path)."""
+        parts = path.split('/', 1)
+        if len(parts) == 1:
+            return parts[0], ''
+        return parts[0], parts[1]
+
+    def _is_linkable(self, bundle, relpath, bundles):
+        """Whether a changed repo path maps to an individual link in root."""
+        if bundle not in bundles or not relpath:
+            return False
+
+        if self.ignore_rules.ignores_path(relpath):
+            return False
+
+        # Paths beneath a tracked directory are covered by the directory
+        # symlink
+        src_dirpath = os.path.dirname(
+            os.path.join(self.repo_path, bundle, relpath))
+        return not self._is_directory_tracked(src_dirpath)
+
+    def _winning_bundle(self, relpath, bundles):
+        for bundle in bundles:
+            src_path = os.path.join(self.repo_path, bundle, relpath)
+            if os.path.lexists(src_path) and not os.path.isdir(src_path):
+                return bundle
+        return None
+
+    def _link_path(self, bundle, relpath, owned, undo_log):
+        src_path = os.path.join(self.repo_path, bundle, relpath)
+        dst_path = os.path.join(self.root_path, relpath)
+
+        for dirpath in utils.parent_directories(dst_path):
+            if not dirpath.startswith(self.root_path + '/'):
+                continue
+            if utils.mkdir(dirpath, dry_run=self.dry_run, undo_log=undo_log):
+                owned[dirpath] = (bundle, 'directory')
+
+        # A less specific bundle may currently supply this path
+        if self._links_into_repo(dst_path):
+            utils.replace_symlink(src_path, dst_path, dry_run=self.dry_run,
+                                  undo_log=undo_log)
+        else:
+            utils.symlink(src_path, dst_path, dry_run=self.dry_run,
+                          undo_log=undo_log)
+        owned[dst_path] = (bundle, 'symlink')
+
+    def _prune_directories(self, dirpath, owned, undo_log):
+        """Remove now-empty directories that `link` created."""
+        while dirpath.startswith(self.root_path + '/'):
+            if owned.get(dirpath, (None, None))[1] != 'directory':
+                return
+            if not os.path.isdir(dirpath) or os.listdir(dirpath):
+                return
+            utils.rmdir(dirpath, dry_run=self.dry_run, undo_log=undo_log)
+            del owned[dirpath]
+            dirpath = os.path.dirname(dirpath)
+
+    def _relink_conflicts(self, linking):
+        """Every file in the way of the (bundle, relpath) links to be made,
+        found before anything is changed.
+        """
+        conflicts = plan.Plan()
+        for bundle, relpath in linking:
+            src_path = os.path.join(self.repo_path, bundle, relpath)
+            dst_path = os.path.join(self.root_path, relpath)
+            for dirpath in utils.parent_directories(dst_path):
+                if not dirpath.startswith(self.root_path + '/'):
+                    continue
+                st = utils.lstat(dirpath)
+                if st is not None and not stat.S_ISDIR(st.st_mode) and \
+                        not stat.S_ISLNK(st.st_mode):
+                    conflicts.add(plan.CONFLICT, dirpath, bundle=bundle,
+                                  reason="'%s' is not a directory. Remove "
+                                         "file before linking." % dirpath)
+                    break
+            else:
+                st = utils.lstat(dst_path)
+                if st is not None and not stat.S_ISLNK(st.st_mode):
+                    conflicts.add(plan.CONFLICT, dst_path, source=src_path,
+                                  bundle=bundle,
+                                  reason="'%s' is not a symlink. Remove file "
+                                         "before linking." % dst_path)
+        return conflicts.conflicts
+
+    @utils.cache_stats
+    @profiling.timed('incremental relink')
+    def _relink_changes(self, added, removed):
+        """Create and remove only the links affected by the given
+        repo-relative paths.
+
+        Nothing is changed if anything is in the way of the new links;
+        every such path is named in the `Conflicts` raised.
+        """
+        bundles = self._selected_bundles(self._relinkable_bundles())
+        utils.log('Relinking %d added and %d removed paths'
+                  % (len(added), len(removed)))
+
+        # The repo is already updated, so which bundle wins each added path
+        # doesn't depend on the removals
+        linking = []
+        for path in sorted(added):
+            bundle, relpath = self._split_repo_path(path)
+            if self._is_linkable(bundle, relpath, bundles) and \
+                    self._winning_bundle(relpath, bundles) == bundle:
+                linking.append((bundle, relpath))
+
+        conflicts = self._relink_conflicts(linking)
+        if conflicts:
+            raise Conflicts(conflicts)
+
+        entries = self.manifest.read(self.root_path)
+        owned = dict((path, (bundle, kind)) for bundle, kind, path in entries)
+        order = [path for bundle, kind, path in entries]
+        undo_log = []
+
+        try:
+            for path in sorted(removed):
+                bundle, relpath = self._split_repo_path(path)
+                if not relpath:
+                    continue
+
+                # Decided by where the link points rather than by which
+                # bundles are selected, so that links into a custom bundle
+                # deleted outright are removed too
+                src_path = os.path.join(self.repo_path, bundle, relpath)
+                dst_path = os.path.join(self.root_path, relpath)
+                if not (utils.islink(dst_path) and
+                        os.readlink(dst_path) == src_path):
+                    continue
 
-    def sync(self, message=None):
+                # Fall back to a less specific bundle if one supplies it,
+                # retargeting the link in place so it's never missing
+                winner = self._winning_bundle(relpath, bundles)
+                if winner and \
+                        not self._is_linkable(winner, relpath, bundles):
+                    winner = None
+                if winner:
+                    utils.replace_symlink(
+                        os.path.join(self.repo_path, winner, relpath),
+                        dst_path, dry_run=self.dry_run, undo_log=undo_log)
+                    owned[dst_path] = (winner, 'symlink')
+                else:
+                    utils.remove_symlink(dst_path, dry_run=self.dry_run,
+                                         undo_log=undo_log)
+                    owned.pop(dst_path, None)
+                    self._prune_directories(
+                        os.path.dirname(dst_path), owned, undo_log)
+
+            for bundle, relpath in linking:
+                before = set(owned)
+                self._link_path(bundle, relpath, owned, undo_log)
+                order.extend(sorted(set(owned) - before))
+        except utils.NotASymlink as e:
+            utils.undo_operations(undo_log)
+            raise NotASymlink(str(e))
+        except:
+            utils.undo_operations(undo_log)
+            raise
+
+        if not self.dry_run:
+            seen = set()
+            updated = []
+            for path in order:
+                if path in owned and path not in seen:
+                    bundle, kind = owned[path]
+                    updated.append((bundle, kind, path))
+                    seen.add(path)
+            self.manifest.write(updated, root_path=self.root_path)
+
+    def relink_paths(self, added, removed, modified=()):
+        """Link and unlink only what is affected by repo-relative paths that
+        appeared in or left the repo, falling back to a full reconcile when
+        the change affects which directories are tracked or which paths are
+        ignored, touches a template, or touches a collapsed directory.
+
+        Paths that were only `modified` matter just for those checks, since
+        existing links keep pointing at the right file.
+        """
+        structural = [p for p in added | removed | set(modified)
+                      if os.path.basename(p) == '.trackeddir' or
+                      p.endswith(template.TEMPLATE_SUFFIX) or
+                      p in (ignore.IGNORE_FILENAME, deploy.DEPLOY_FILENAME,
+                            template.VARS_FILENAME)]
+        if structural or (self.collapse_directories and
+                          self._touches_collapsed(added | removed)):
+            self.relink()
+            return
+
+        # Incremental relinking only makes symlinks
+        deploy_rules = self.deploy_rules
+        if deploy_rules.rules and any(
+                deploy_rules.mode(self._split_repo_path(p)[1]) !=
+                deploy.SYMLINK for p in added | removed):
+            self.relink()
+            return
+
+        self._relink_changes(added, removed)
+
+        # Copies may be stale even where no path came or went
+        if deploy_rules.rules:
+            self._refresh_deployed()
+
+    def _refresh_deployed(self):
+        """Bring the copies and hard links in the manifest up to date with
+        their sources, or pull edits made in the root back into the repo.
+        """
+        pending = plan.Plan()
+        prefix_len = len(self.root_path) + 1
+        for bundle, kind, path in self.manifest.read(self.root_path):
+            if kind not in (plan.COPY, plan.HARDLINK):
+                continue
+            source = os.path.join(self.repo_path, bundle, path[prefix_len:])
+            if not os.path.lexists(source):
+                continue
+            plan._plan_deployed(
+                pending, kind, source, path, utils.lstat(path), bundle,
+                lambda dst_path, src_path: self._links_into_repo(dst_path),
+                self.hash_cache)
+
+        if pending.conflicts:
+            raise Conflicts(pending.conflicts)
+
+        self._apply_plan(pending, [], 'link')
+        if not self.dry_run:
+            self.hash_cache.save()
+
+    def _reset_repo_state(self):
+        """Forget what was read from the repo's tree and config files."""
+        self._invalidate_tree()
+        self._ignore_rules = None
+        self._deploy_rules = None
+        self.templates.reset()
+
+    def invalidate(self):
+        """Forget everything cached about the repo and this machine, e.g.
+        after another process changed them.
+        """
+        self._reset_repo_state()
+        self.hash_cache.invalidate()
+        self.templates.invalidate()
+        self._platforms = None
+
+    def relink(self):
+        """Bring the root in line with the repo as it is now."""
+        self._reset_repo_state()
+        self._reconcile(self.manifest.read(self.root_path))
+
+    def _relink_incremental(self, old_commit, new_commit):
+        """Relink only what changed between two commits."""
+        if old_commit == new_commit:
+            return
+
+        added, removed, modified = self.git.changed_paths(old_commit,
+                                                          new_commit)
+        self.relink_paths(added, removed, modified)
+        if not self.dry_run:
+            self._record_linked_commit(new_commit)
+
+    def sync(self, message=None, prompt=True):
+        """Commit, merge origin's changes, relink and push.
+
+        If the repo has no origin, ask for one, or with `prompt` False
+        raise NoRemote.
+        """
         if self.git.uncommitted_changes():
             self.git.commit(all=True, message=message)
 
         stdout, stderr = self.git.remote()
         if stdout is not None and 'origin' not in stdout:
+            if not prompt:
+                raise NoRemote("The repo has no 'origin' remote to sync with")
             origin = raw_input('GitHub username or URL to repo: ')
             url = self._make_remote_url(origin)
             self.git.remote('add', 'origin', url)
 
-        # The `unlink` operation that follows may potentially unlink our
-        # global .gitconfig, making it impossible to generate a merge-commit.
-        # To break out of this chicken-and-egg problem, we push the global
-        # .gitconfig state into the local .gitconfig before it goes away
+        # Relinking after the merge may retarget or remove our global
+        # .gitconfig, so we push the global .gitconfig state into the local
+        # .gitconfig to make sure later merge-commits can still be made
         self._populate_local_gitconfig('user.name')
         self._populate_local_gitconfig('user.email')
 
-        self.unlink(clear_custom_bundle_state=False)
-        try:
-            self.git.pull_origin()
-        finally:
-            self._relink()
+        old_commit = self.linked_commit_state.read()
+        incremental = old_commit and self.manifest.exists()
+
+        # Record what is linked while the old tree is still checked out;
+        # repos linked before the manifest existed need a walk for this
+        linked = None if incremental else self._linked_entries()
+
+        # Only the fetch touches the network. Every link stays in place
+        # until the merge is done, and then just the changed ones are
+        # swapped, so $HOME is never left unlinked while waiting on origin
+        self.git.fetch_origin()
+        self.git.merge_fetch_head()
+        self._reset_repo_state()
+
+        new_commit = self.git.head_commit()
+        if incremental and new_commit:
+            self._relink_incremental(old_commit, new_commit)
+        elif linked is not None:
+            self._reconcile(linked)
 
         self.git.push_origin()
 
+    def watch(self, debounce=None, interval=None):
+        """Relink as files appear in and leave the repo and commit edits
+        once they settle, until interrupted.
+        """
+        import watch
+        watcher = watch.Watcher(self, debounce=debounce or watch.DEBOUNCE,
+                                interval=interval or watch.POLL_INTERVAL)
+        watcher.run()
+
     def _make_remote_url(self, origin):
         if '://' in origin:
             url = origin
@@ -378,11 +1882,24 @@ class Homefiles(object):
             url = "git@github.com:%(username)s/%(repo)s.git" % data
         return url
 
-    def clone(self, origin):
+    def clone(self, origin, depth=None, partial=False, sparse=False,
+              selected=None):
+        """Clone the repo from `origin`.
+
+        `depth` limits the history fetched to that many commits and
+        `partial` leaves file contents on the server until they are checked
+        out. With `sparse` only the bundles this machine would link, plus
+        the `selected` custom bundles, are checked out; `link` and `track`
+        check out more bundles as they need them.
+        """
+        import git
+
         url = self._make_remote_url(origin)
 
         try:
-            self.git.clone(url, dry_run=self.dry_run)
+            self.git.clone(url, dry_run=self.dry_run, depth=depth,
+                           filter='blob:none' if partial else None,
+                           no_checkout=sparse)
         except git.NotAuthorizedToClone:
             raise NotAuthorizedToClone(
                 'Permission denied. Add SSH key to GitHub.')
@@ -394,6 +1911,17 @@ class Homefiles(object):
         repo_name = url.split('/')[-1].replace('.git', '')
         utils.rename(repo_name, self.repo_path, dry_run=self.dry_run)
 
+        if sparse and not self.dry_run:
+            self.git.sparse_checkout('init', '--cone')
+            self.sparse_checkout.invalidate()
+            # Bundles for other platforms are included even if the repo
+            # doesn't have them yet, so that they're checked out once
+            # another machine adds them
+            self.git.sparse_checkout('set',
+                                     *self._selected_bundles(selected))
+            self.git.checkout()
+            self._invalidate_tree()
+
     def init(self):
         if os.path.exists(self.repo_path):
             utils.warn("Homefiles repo already exists at '%s'"
@@ -407,10 +1935,10 @@ class Homefiles(object):
         dst_path = utils.truepath(path)
 
         if not os.path.exists(dst_path):
-            raise Exception("Path '%s' not found" % dst_path)
+            raise PathNotFound("Path '%s' not found" % dst_path)
 
         if not os.path.islink(dst_path):
-            raise Exception("Path '%s' is not a symlink" % dst_path)
+            raise NotASymlink("Path '%s' is not a symlink" % dst_path)
 
         src_path = os.path.realpath(dst_path)
 
@@ -422,7 +1950,12 @@ class Homefiles(object):
             utils.undo_operations(undo_log)
             raise
 
+        if not self.dry_run:
+            self.manifest.write([e for e in self.manifest.read()
+                                 if e[2] != dst_path])
+
         self.git.rm(src_path)
+        self._invalidate_tree()
         self.git.commit(message="Untracking '%s'" % path)
 
     def diff(self):
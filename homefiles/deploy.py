@@ -0,0 +1,215 @@
+"""Per-path deploy modes for files that can't be symlinks.
+
+Some applications replace a symlink with a regular file when they save. For
+those paths the repo's `.homefilesdeploy` can ask for a hard link or a copy
+instead, one mode and gitignore-style pattern per line:
+
+    copy      .config/Code/User/settings.json
+    hardlink  .gitconfig
+
+Patterns match bundle-relative paths as in `.homefilesignore`, a pattern
+matching a directory applies to everything beneath it, and the last
+matching line wins.
+
+Whether a copy needs refreshing, or has been edited and should be pulled
+back into the repo, is decided by comparing content digests. `HashCache`
+remembers them by (path, size, mtime) so that an unchanged file costs a
+single stat.
+"""
+import os
+import time
+
+import ignore
+import profiling
+import utils
+
+
+DEPLOY_FILENAME = '.homefilesdeploy'
+
+SYMLINK = 'symlink'
+HARDLINK = 'hardlink'
+COPY = 'copy'
+MODES = (SYMLINK, HARDLINK, COPY)
+
+
+class InvalidDeployRule(ValueError):
+    pass
+
+
+class DeployRules(object):
+    def __init__(self, rules, modes):
+        self.rules = rules
+        self.modes = modes
+        indexed_rules = list(enumerate(rules))
+        self._dir_regex = ignore._compile(indexed_rules)
+        self._file_regex = ignore._compile(
+            [(idx, rule) for idx, rule in indexed_rules
+             if not rule.directory_only])
+
+    @classmethod
+    def from_lines(cls, lines):
+        rules = []
+        modes = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                mode, pattern = line.split(None, 1)
+            except ValueError:
+                raise InvalidDeployRule("Expected '<mode> <pattern>': '%s'"
+                                        % line)
+            if mode not in MODES:
+                raise InvalidDeployRule("Unknown deploy mode '%s'" % mode)
+
+            rules.append(ignore.Rule(pattern))
+            modes.append(mode)
+
+        return cls(rules, modes)
+
+    @classmethod
+    def from_repo(cls, repo_path):
+        path = os.path.join(repo_path, DEPLOY_FILENAME)
+        if not os.path.exists(path):
+            return cls([], [])
+        with open(path) as f:
+            return cls.from_lines(f)
+
+    def mode(self, relpath):
+        """The deploy mode for a bundle-relative file path."""
+        if not self.rules:
+            return SYMLINK
+
+        winner = None
+        parts = relpath.split('/')
+        for depth in range(1, len(parts) + 1):
+            if depth < len(parts):
+                regex = self._dir_regex
+            else:
+                regex = self._file_regex
+            if regex is None:
+                continue
+            idx = ignore._winning_rule(regex, '/'.join(parts[:depth]))
+            if idx is not None:
+                if winner is None or idx > winner:
+                    winner = idx
+
+        if winner is None or self.rules[winner].negated:
+            return SYMLINK
+        return self.modes[winner]
+
+
+def _mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return mtime_ns
+
+
+class HashCache(object):
+    """Content digests keyed by (path, size, mtime), plus the digest that was
+    last deployed to each copied or hard-linked path, kept in
+    .git/homefiles-hashes.
+    """
+    # A file changed again within this many seconds of being hashed could
+    # keep the same size and mtime, so such digests aren't trusted later
+    RACY_SECONDS = 2
+
+    def __init__(self, repo_path):
+        self.path = os.path.join(repo_path, '.git', 'homefiles-hashes')
+        self._hashes = None
+        self._deployed = None
+        self._dirty = False
+
+    def _load(self):
+        self._hashes = {}
+        self._deployed = {}
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'H':
+                    path, size, mtime_ns, digest = fields[1:]
+                    self._hashes[path] = (int(size), int(mtime_ns), digest)
+                elif fields[0] == 'D':
+                    path, digest = fields[1:]
+                    self._deployed[path] = digest
+
+    def invalidate(self):
+        """Read the file again on next use, e.g. after another process wrote
+        it.
+        """
+        self._hashes = None
+        self._deployed = None
+        self._dirty = False
+
+    def _ensure_loaded(self):
+        if self._hashes is None:
+            self._load()
+
+    def digest(self, path, st=None):
+        """Digest of a file's contents, read only if its size or mtime
+        changed since the last time.
+        """
+        self._ensure_loaded()
+        if st is None:
+            st = utils.lstat(path)
+
+        key = (st.st_size, _mtime_ns(st))
+        cached = self._hashes.get(path)
+        if cached is not None and cached[:2] == key:
+            return cached[2]
+
+        import hashlib
+
+        profiling.count('hash')
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        self.record(path, st, digest)
+        return digest
+
+    def record(self, path, st, digest):
+        """Remember the digest of a file whose contents are already known,
+        e.g. one that was just copied.
+        """
+        self._ensure_loaded()
+        if time.time() - st.st_mtime < self.RACY_SECONDS:
+            self._hashes.pop(path, None)
+        else:
+            self._hashes[path] = (st.st_size, _mtime_ns(st), digest)
+        self._dirty = True
+
+    def deployed(self, path):
+        self._ensure_loaded()
+        return self._deployed.get(path)
+
+    def set_deployed(self, path, digest):
+        self._ensure_loaded()
+        if self._deployed.get(path) != digest:
+            self._deployed[path] = digest
+            self._dirty = True
+
+    def forget_deployed(self, path):
+        self._ensure_loaded()
+        if self._deployed.pop(path, None) is not None:
+            self._hashes.pop(path, None)
+            self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        with open(self.path, 'w') as f:
+            for path, (size, mtime_ns, digest) in sorted(
+                    self._hashes.items()):
+                f.write('H\t%s\t%d\t%d\t%s\n' % (path, size, mtime_ns, digest))
+            for path, digest in sorted(self._deployed.items()):
+                f.write('D\t%s\t%s\n' % (path, digest))
+        self._dirty = False
@@ -0,0 +1,93 @@
+"""Machine-readable progress for `--json`.
+
+Every operation `utils.log` announces is written to stdout as a JSON object
+on its own line as soon as it completes, followed at exit by a summary.
+Like `profiling`, everything here is a no-op until `enable` is called.
+
+    {"event": "op", "op": "symlink", "src": "...", "dst": "...",
+     "bundle": "Default", "result": "done", "duration": 0.000041, ...}
+"""
+import json
+import sys
+import time
+
+
+ENABLED = False
+
+_STREAM = None
+_LOCK = None
+# Per thread, since roots are linked in parallel: the operation announced
+# but not yet completed, and fields such as the bundle being applied
+_LOCAL = None
+_START = time.time()
+_COUNTS = {}
+
+
+def enable(stream=None):
+    global ENABLED, _STREAM, _START, _LOCK, _LOCAL
+    # Imported here so that commands without --json never load threading
+    import threading
+
+    ENABLED = True
+    _LOCK = threading.Lock()
+    _LOCAL = threading.local()
+    _STREAM = stream or sys.stdout
+    _START = time.time()
+    _COUNTS.clear()
+
+
+def emit(event, **fields):
+    if not ENABLED:
+        return
+
+    fields['event'] = event
+    line = json.dumps(fields, sort_keys=True)
+    with _LOCK:
+        _STREAM.write(line + '\n')
+        _STREAM.flush()
+
+
+def set_context(**fields):
+    """Add `fields` to this thread's operation events until the next call."""
+    if ENABLED:
+        _LOCAL.context = fields
+
+
+def begin(op, message, src=None, dst=None):
+    if not ENABLED:
+        return
+
+    # An operation that raised before reporting how it went
+    finish('failed')
+    _LOCAL.pending = (op, message, src, dst, time.time())
+
+
+def finish(result):
+    """Emit the pending operation with `result`; False if there was none."""
+    pending = getattr(_LOCAL, 'pending', None)
+    if pending is None:
+        return False
+
+    _LOCAL.pending = None
+    op, message, src, dst, start = pending
+    with _LOCK:
+        results = _COUNTS.setdefault(op, {})
+        results[result] = results.get(result, 0) + 1
+
+    fields = dict(getattr(_LOCAL, 'context', None) or {})
+    emit('op', op=op, message=message, src=src, dst=dst, result=result,
+         duration=round(time.time() - start, 6), **fields)
+    return True
+
+
+def summary(command, exit_status, error=None):
+    if not ENABLED:
+        return
+
+    finish('failed')
+    fields = {}
+    if error is not None:
+        fields['error'] = error
+    emit('summary', command=command, exit_status=exit_status,
+         ok=exit_status == 0, duration=round(time.time() - _START, 6),
+         counts=dict(_COUNTS), **fields)
@@ -2,6 +2,7 @@ import errno
 import os
 import subprocess
 
+import profiling
 import utils
 
 
@@ -50,6 +51,7 @@ class RawGitRepo(object):
         if dry_run:
             return None, None
 
+        profiling.count('git')
         try:
             proc = subprocess.Popen(['git'] + args,
                                     stdout=subprocess.PIPE,
@@ -67,30 +69,41 @@ class RawGitRepo(object):
     @classmethod
     def _run_without_output_captured(cls, args, dry_run=False, ret_codes=None):
         if not dry_run:
+            profiling.count('git')
             ret_code = subprocess.call(['git'] + args)
             cls._check_return_code(ret_code, None, None, ret_codes=ret_codes)
 
 
-    def _run(self, args, ret_codes=None, capture_output=True):
+    def _run(self, args, ret_codes=None, capture_output=True,
+             read_only=False):
+        # Read-only queries are safe to run even during a dry-run
+        dry_run = self.dry_run and not read_only
         orig_path = os.getcwd()
         os.chdir(self.path)
         try:
-            if capture_output:
-                return self._run_with_output_captured(
-                        args, dry_run=self.dry_run, ret_codes=ret_codes)
-            else:
-                return self._run_without_output_captured(
-                        args, dry_run=self.dry_run, ret_codes=ret_codes)
+            with profiling.phase('git %s' % args[0]):
+                if capture_output:
+                    return self._run_with_output_captured(
+                            args, dry_run=dry_run, ret_codes=ret_codes)
+                else:
+                    return self._run_without_output_captured(
+                            args, dry_run=dry_run, ret_codes=ret_codes)
         finally:
             os.chdir(orig_path)
 
-    def add(self, path):
-        utils.log("Adding '%s' to Git" % path, newline=False)
-        self._run(['add', path])
+    def add(self, *paths):
+        if len(paths) == 1:
+            utils.log("Adding '%s' to Git" % paths[0], newline=False,
+                      op='git-add')
+        else:
+            utils.log("Adding %d paths to Git" % len(paths), newline=False,
+                      op='git-add')
+        self._run(['add', '--'] + list(paths))
         utils.log("[DONE]")
 
     def rm(self, path):
-        utils.log("Removing '%s' from Git" % path, newline=False)
+        utils.log("Removing '%s' from Git" % path, newline=False,
+                  op='git-rm')
         self._run(['rm', path])
         utils.log("[DONE]")
 
@@ -100,7 +113,8 @@ class RawGitRepo(object):
             cmd_args.append('--global')
         cmd_args.append(config)
         cmd_args.extend(args)
-        utils.log("Configuring %s in Git" % config, newline=False)
+        utils.log("Configuring %s in Git" % config, newline=False,
+                  op='git-config')
         results = self._run(cmd_args, ret_codes=kwargs.get('ret_codes'))
         utils.log("[DONE]")
         return results
@@ -111,39 +125,105 @@ class RawGitRepo(object):
             args.append('-a')
         if message:
             args.extend(['-m', message])
-        utils.log("Commiting to Git", newline=False)
+        utils.log("Commiting to Git", newline=False, op='git-commit')
         self._run(args)
         utils.log("[DONE]")
 
     def diff(self, *args, **kwargs):
         capture_output = kwargs.get('capture_output', True)
-        utils.log("Diffing %s" % ' '.join(args), newline=False)
+        utils.log("Diffing %s" % ' '.join(args), newline=False,
+                  op='git-diff')
         results = self._run(['diff'] + list(args),
                             capture_output=capture_output)
         utils.log("[DONE]")
         return results
 
-    def diff_index(self, treeish):
-        utils.log("Diffing index to %s" % treeish, newline=False)
-        results = self._run(['diff-index', treeish])
+    def diff_index(self, treeish, *args):
+        utils.log("Diffing index to %s" % treeish, newline=False,
+                  op='git-diff-index')
+        results = self._run(['diff-index'] + list(args) + [treeish],
+                            read_only=True)
+        utils.log("[DONE]")
+        return results
+
+    def refresh_index(self):
+        # Files that were touched without being changed otherwise show up as
+        # modified in diff-index
+        utils.log("Refreshing index", newline=False, op='git-update-index')
+        results = self._run(['update-index', '-q', '--refresh'],
+                            ret_codes=[0, 1])
+        utils.log("[DONE]")
+        return results
+
+    def diff_name_status(self, old, new):
+        utils.log("Diffing %s..%s" % (old, new), newline=False,
+                  op='git-diff')
+        # No rename detection, which in a partial clone would download the
+        # contents of every added and removed file
+        results = self._run(['diff', '--name-status', '-z', '--no-renames',
+                             old, new])
         utils.log("[DONE]")
         return results
 
+    def ls_files(self, *pathspecs, **kwargs):
+        args = ['ls-files', '-z']
+        if kwargs.get('others', False):
+            args.extend(['--cached', '--others'])
+        return self._run(args + ['--'] + list(pathspecs), read_only=True)
+
+    def ls_tree(self, *args):
+        return self._run(['ls-tree'] + list(args), read_only=True)
+
+    def get_config(self, config, *args):
+        return self._run(['config'] + list(args) + [config],
+                         ret_codes=[0, 1], read_only=True)
+
+    def sparse_checkout(self, *args):
+        utils.log("Setting sparse checkout to %s" % ' '.join(args),
+                  newline=False, op='git-sparse-checkout')
+        self._run(['sparse-checkout'] + list(args))
+        utils.log("[DONE]")
+
+    def checkout(self, *args):
+        utils.log("Checking out %s" % (' '.join(args) or 'HEAD'),
+                  newline=False, op='git-checkout')
+        self._run(['checkout'] + list(args))
+        utils.log("[DONE]")
+
     def init(self):
-        utils.log("Initializing repo at '%s'" % self.path, newline=False)
+        utils.log("Initializing repo at '%s'" % self.path, newline=False,
+                  op='git-init')
         self._run(['init', '.'])
         utils.log("[DONE]")
 
     def pull_origin(self):
-        utils.log("Pulling origin", newline=False)
+        utils.log("Pulling origin", newline=False, op='git-pull')
         self._run(['pull', 'origin', 'master'])
         utils.log("[DONE]")
 
+    def fetch_origin(self):
+        utils.log("Fetching origin", newline=False, op='git-fetch')
+        self._run(['fetch', 'origin', 'master'])
+        utils.log("[DONE]")
+
+    def merge_fetch_head(self):
+        utils.log("Merging FETCH_HEAD", newline=False, op='git-merge')
+        self._run(['merge', '--no-edit', 'FETCH_HEAD'])
+        utils.log("[DONE]")
+
     def push_origin(self):
-        utils.log("Pushing origin", newline=False)
+        utils.log("Pushing origin", newline=False, op='git-push')
         self._run(['push', 'origin', 'master'])
         utils.log("[DONE]")
 
+    def rev_list_count(self, revisions):
+        return self._run(['rev-list', '--count', revisions],
+                         ret_codes=[0, 128], read_only=True)
+
+    def rev_parse(self, ref):
+        return self._run(['rev-parse', '--verify', '-q', ref],
+                         ret_codes=[0, 1, 128], read_only=True)
+
     def remote(self, *args, **kwargs):
         cmd_args = ['remote']
         if kwargs.get('verbose', False):
@@ -152,17 +232,27 @@ class RawGitRepo(object):
         return self._run(cmd_args)
 
     @classmethod
-    def clone(cls, url, dry_run=False):
-        return cls._run_with_output_captured(['clone', url], dry_run=dry_run)
+    def clone(cls, url, dry_run=False, depth=None, filter=None,
+              no_checkout=False):
+        args = ['clone']
+        if depth:
+            args.extend(['--depth', str(depth)])
+        if filter:
+            args.append('--filter=%s' % filter)
+        if no_checkout:
+            args.append('--no-checkout')
+        args.append(url)
+        return cls._run_with_output_captured(args, dry_run=dry_run)
 
 
 class GitRepo(RawGitRepo):
     @classmethod
-    def clone(cls, url, dry_run=False):
-        utils.log("Cloning '%s'" % url, newline=False)
+    def clone(cls, url, dry_run=False, **kwargs):
+        utils.log("Cloning '%s'" % url, newline=False, op='git-clone')
 
         try:
-            return super(GitRepo, cls).clone(url, dry_run=dry_run)
+            results = super(GitRepo, cls).clone(url, dry_run=dry_run,
+                                                **kwargs)
         except ProcessException as e:
             if 'Permission denied (publickey)' in e.stderr:
                 raise NotAuthorizedToClone
@@ -172,9 +262,96 @@ class GitRepo(RawGitRepo):
                 raise
 
         utils.log("[DONE]")
+        return results
+
+    def sparse_checkout_enabled(self):
+        stdout, stderr = self.get_config('core.sparseCheckout', '--bool')
+        return bool(stdout) and stdout.strip() == 'true'
+
+    def top_level_directories(self, treeish='HEAD'):
+        """Return the names of the directories at the top of `treeish`."""
+        stdout, stderr = self.ls_tree('-d', '--name-only', '-z', treeish)
+        if not stdout:
+            return []
+        return [name for name in stdout.split('\0') if name]
 
     def uncommitted_changes(self):
         stdout, stderr = self.diff_index('HEAD')
         if stdout is None:
             return False
         return len(stdout) != 0
+
+    def uncommitted_paths(self):
+        """Return {repo-relative path: status letter} for every path in the
+        working tree that differs from HEAD, e.g. 'D' for a deleted one.
+        """
+        stdout, stderr = self.diff_index('HEAD', '--name-status', '-z')
+        if not stdout:
+            return {}
+
+        fields = stdout.split('\0')
+        return dict((fields[idx + 1], fields[idx][0])
+                    for idx in range(0, len(fields) - 1, 2))
+
+    def head_commit(self):
+        stdout, stderr = self.rev_parse('HEAD')
+        if not stdout:
+            return None
+        return stdout.strip()
+
+    def commits_ahead(self, upstream='origin/master'):
+        """Number of local commits not in `upstream`, as of the last fetch;
+        None if there is no such upstream.
+        """
+        stdout, stderr = self.rev_list_count('%s..HEAD' % upstream)
+        if not stdout:
+            return None
+        return int(stdout.strip())
+
+    def tracked_directory_markers(self):
+        """Return repo-relative paths of every committed, staged or
+        untracked .trackeddir marker.
+        """
+        stdout, stderr = self.ls_files('*/.trackeddir', others=True)
+        return [path for path in stdout.split('\0')
+                if os.path.basename(path) == '.trackeddir']
+
+    def index_paths(self):
+        """Return repo-relative paths of every file in the index."""
+        stdout, stderr = self.ls_files()
+        return [path for path in stdout.split('\0') if path]
+
+    def changed_paths(self, old, new):
+        """Return the (added, removed, modified) paths between two commits.
+
+        Renames are reported as a removal of the old path and an addition of
+        the new one.
+        """
+        added = set()
+        removed = set()
+        modified = set()
+        stdout, stderr = self.diff_name_status(old, new)
+        if not stdout:
+            return added, removed, modified
+
+        fields = stdout.split('\0')
+        idx = 0
+        while idx < len(fields) and fields[idx]:
+            status = fields[idx][0]
+            if status in ('R', 'C'):
+                old_path, new_path = fields[idx + 1], fields[idx + 2]
+                if status == 'R':
+                    removed.add(old_path)
+                added.add(new_path)
+                idx += 3
+            else:
+                path = fields[idx + 1]
+                if status == 'A':
+                    added.add(path)
+                elif status == 'D':
+                    removed.add(path)
+                else:
+                    modified.add(path)
+                idx += 2
+
+        return added, removed, modified
@@ -0,0 +1,160 @@
+"""Gitignore-style matching for bundle paths that should never be linked.
+
+Patterns come from the built-in defaults followed by the repo's
+`.homefilesignore` and are matched against paths relative to the bundle
+root, so `/bin/scratch` ignores `$HOME/bin/scratch` in every bundle.
+Patterns are compiled into as few regular expressions as `re` allows, so the
+cost of a lookup barely grows with the number of patterns.
+"""
+import os
+import re
+
+
+IGNORE_FILENAME = '.homefilesignore'
+
+# Python 2's `re` supports at most 100 named groups per expression
+MAX_GROUPS = 99
+
+
+def _translate(pattern):
+    """Translate a gitignore glob into a regular expression fragment."""
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            if pattern[i:i + 3] == '**/':
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+            elif pattern[i:i + 2] == '**':
+                res.append('.*')
+                i += 2
+                continue
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                res.append('\\[')
+            else:
+                stuff = pattern[i + 1:j].replace('\\', '\\\\')
+                if stuff[0] == '!':
+                    stuff = '^' + stuff[1:]
+                res.append('[%s]' % stuff)
+                i = j
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pattern[i + 1]))
+            i += 1
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+
+class Rule(object):
+    def __init__(self, pattern):
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+
+        self.directory_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+
+        # A slash anywhere but the end anchors the pattern to the bundle
+        # root, otherwise it matches a name at any depth
+        self.anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+
+        if self.anchored:
+            self.regex = _translate(pattern)
+        else:
+            self.regex = '(?:.*/)?' + _translate(pattern)
+
+
+def parse(lines):
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n').rstrip(' ')
+        if not line or line.startswith('#'):
+            continue
+        rules.append(Rule(line))
+    return rules
+
+
+def _compile(indexed_rules):
+    if not indexed_rules:
+        return None
+
+    # Later rules take precedence, so they go first in each alternation,
+    # and the chunk holding the latest rules is tried first; the name of
+    # the group that matched tells us which rule won
+    regexes = []
+    for start in range(0, len(indexed_rules), MAX_GROUPS):
+        alternatives = [
+            '(?P<r%d>%s)' % (idx, rule.regex)
+            for idx, rule in reversed(indexed_rules[start:start + MAX_GROUPS])]
+        regexes.append(re.compile('^(?:%s)$' % '|'.join(alternatives)))
+    regexes.reverse()
+    return regexes
+
+
+def _winning_rule(regexes, relpath):
+    """The index of the last rule matching `relpath`, or None."""
+    for regex in regexes:
+        m = regex.match(relpath)
+        if m is not None:
+            return int(m.lastgroup[1:])
+    return None
+
+
+class IgnoreRules(object):
+    def __init__(self, rules):
+        self.rules = rules
+        indexed_rules = list(enumerate(rules))
+        self._dir_regex = _compile(indexed_rules)
+        self._file_regex = _compile(
+            [(idx, rule) for idx, rule in indexed_rules
+             if not rule.directory_only])
+
+    @classmethod
+    def from_patterns(cls, patterns):
+        return cls(parse(patterns))
+
+    @classmethod
+    def from_repo(cls, repo_path, defaults=None):
+        lines = list(defaults or [])
+        path = os.path.join(repo_path, IGNORE_FILENAME)
+        if os.path.exists(path):
+            with open(path) as f:
+                lines.extend(f.readlines())
+        return cls(parse(lines))
+
+    def match(self, relpath, is_dir=False):
+        """Whether a bundle-relative path is ignored by its own name.
+
+        Callers walking top-down never reach the children of an ignored
+        directory; use `ignores_path` to also account for parents.
+        """
+        regex = self._dir_regex if is_dir else self._file_regex
+        if regex is None:
+            return False
+
+        idx = _winning_rule(regex, relpath)
+        if idx is None:
+            return False
+
+        return not self.rules[idx].negated
+
+    def ignores_path(self, relpath):
+        """Whether a bundle-relative file path or any of its parent
+        directories is ignored.
+        """
+        parts = relpath.split('/')
+        for idx in range(1, len(parts)):
+            if self.match('/'.join(parts[:idx]), is_dir=True):
+                return True
+        return self.match(relpath)
@@ -1,21 +1,84 @@
+import atexit
 import optparse
 import os
+import signal
 import sys
 
+import events
 import homefiles
+import profiling
+import session
 import utils
 import version
 
 
-DEFAULT_REMOTE_REPO = '.homefiles'
-DEFAULT_REPO = '~/.homefiles'
-DEFAULT_ROOT = '~'
+def report_roots(results):
+    """Print how each root fared and exit non-zero if any failed."""
+    failed = False
+    for root_path, error in results:
+        if events.ENABLED:
+            events.emit('root', root=root_path, ok=error is None,
+                        error=error and str(error))
+            failed = failed or error is not None
+        elif error is None:
+            print 'ok      %s' % root_path
+        else:
+            print 'FAILED  %s: %s' % (root_path, error)
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+def print_suppliers(node):
+    """Print the bundle a path is linked from, then those it shadows, or
+    for a directory every bundle merged into it.
+    """
+    if node.kind == 'directory':
+        for kind, source, bundle in node.suppliers:
+            print '%s  %s' % (bundle, source)
+        return
+
+    print '%s  %s' % (node.bundle, node.source)
+    for kind, source, bundle in node.shadowed:
+        print '%s  %s (shadowed)' % (bundle, source)
+
+
+def node_fields(node):
+    """A node and its suppliers, for `--json` events."""
+    return dict(path=node.relpath, kind=node.kind, bundle=node.bundle,
+                source=node.source,
+                suppliers=[dict(kind=kind, source=source, bundle=bundle)
+                           for kind, source, bundle in node.suppliers],
+                shadowed=[bundle for kind, source, bundle in node.shadowed])
+
+
+def emit_tree(overlay):
+    for node in overlay.nodes(winners_only=True):
+        events.emit('node', **node_fields(node))
+
+
+def print_tree(overlay):
+    for node in overlay.nodes(winners_only=True):
+        depth = node.relpath.count('/')
+        name = os.path.basename(node.relpath)
+        if node.kind == 'directory':
+            print '%s%s/' % ('  ' * depth, name)
+            continue
+
+        line = '%s%-*s %s' % ('  ' * depth, max(1, 40 - 2 * depth), name,
+                              node.bundle)
+        if node.shadowed:
+            line += ' (shadows %s)' % ', '.join(
+                bundle for kind, source, bundle in node.shadowed)
+        print line
 
 
 def usage():
     prog = os.path.basename(sys.argv[0])
-    commands = "[bundles|clone|diff||init|link|sync|track|unlink|untrack]"
-    return "%s [options] %s [filename]" % (prog, commands)
+    commands = ("[bundles|clone|diff||init|link|status|sync|track|tree|"
+                "unlink|untrack|watch|which]")
+    return "%s [options] %s [filename ...]" % (prog, commands)
 
 
 def main():
@@ -26,9 +89,40 @@ def main():
     parser.add_option("-b", "--bundle",
                       action="store", dest="bundle",
                       help="Which bundle to use")
+    parser.add_option("-r", "--root",
+                      action="append", dest="roots",
+                      help="Link or unlink this root instead of "
+                           "HOMEFILES_ROOT; repeat to apply to several roots "
+                           "in parallel")
+    parser.add_option("--backup-dir",
+                      action="store", dest="backup_dir",
+                      help="Move files in the way of links into this "
+                           "directory rather than refusing to link")
+    parser.add_option("--depth",
+                      action="store", dest="depth", type="int",
+                      help="Clone only the last DEPTH commits")
+    parser.add_option("--partial",
+                      action="store_true", dest="partial", default=False,
+                      help="Clone without file contents, fetching them as "
+                           "they are checked out")
+    parser.add_option("--sparse",
+                      action="store_true", dest="sparse", default=False,
+                      help="Check out only the bundles this machine links; "
+                           "link and track check out more as needed")
+    parser.add_option("-j", "--jobs",
+                      action="store", dest="jobs", type="int",
+                      help="How many roots to work on at once")
     parser.add_option("-v", "--verbose",
                       action="store_true", dest="verbose", default=False,
                       help="Turns on verbose output.")
+    parser.add_option("--json",
+                      action="store_true", dest="json", default=False,
+                      help="Stream progress to stdout as one JSON event per "
+                           "line, ending with a summary")
+    parser.add_option("--profile",
+                      action="store_true", dest="profile", default=False,
+                      help="Print per-phase timings and counters as JSON to "
+                           "stderr on exit")
     parser.add_option("--version",
                       action="store_true", dest="version", default=False,
                       help="Print version and exit")
@@ -42,12 +136,17 @@ def main():
     # --dry-run implies --verbose
     utils.LOG_VERBOSE = options.verbose or options.dry_run
 
-    repo_path = utils.truepath(os.getenv('HOMEFILES_REPO') or DEFAULT_REPO)
-    root_path = utils.truepath(os.getenv('HOMEFILES_ROOT') or DEFAULT_ROOT)
-    remote_repo = os.getenv('HOMEFILES_REMOTE_REPO') or DEFAULT_REMOTE_REPO
+    if options.profile:
+        profiling.enable()
+        atexit.register(profiling.write_report)
+
+    if options.roots:
+        roots = [utils.truepath(r) for r in options.roots]
+    else:
+        roots = None
 
-    hf = homefiles.Homefiles(root_path, repo_path, remote_repo,
-                             dry_run=options.dry_run)
+    hf = homefiles.Homefiles(dry_run=options.dry_run,
+                             **session.options_from_environment())
 
     try:
         cmd = args[0]
@@ -56,8 +155,34 @@ def main():
         print >> sys.stderr, usage()
         sys.exit(1)
 
+    if not options.json:
+        run_command(hf, cmd, args, options, roots)
+        return
+
+    events.enable()
+    exit_status = 1
+    error = None
+    try:
+        run_command(hf, cmd, args, options, roots)
+        exit_status = 0
+    except SystemExit as e:
+        exit_status = e.code or 0
+        raise
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        events.summary(cmd, exit_status, error=error)
+
+
+def run_command(hf, cmd, args, options, roots):
     if cmd == 'bundles':
         matching, non_matching = hf.bundle_breakdown()
+        if options.json:
+            events.emit('bundles', matching=sorted(matching),
+                        others=sorted(non_matching))
+            return
+
         print 'Match this machine:'
         for bundle in sorted(matching):
             print '- %s' % bundle
@@ -72,8 +197,15 @@ def main():
         except IndexError:
             print >> sys.stderr, usage()
             sys.exit(1)
+
+        if options.bundle:
+            selected = [s.strip() for s in options.bundle.split(',')]
+        else:
+            selected = None
+
         try:
-            hf.clone(origin)
+            hf.clone(origin, depth=options.depth, partial=options.partial,
+                     sparse=options.sparse, selected=selected)
         except homefiles.HomefilesException as e:
             utils.error(e)
             sys.exit(1)
@@ -91,37 +223,138 @@ def main():
         else:
             selected = None
 
+        if options.backup_dir:
+            backup_path = utils.truepath(options.backup_dir)
+        else:
+            backup_path = None
+
         try:
-            hf.link(selected=selected)
+            results = hf.link(selected=selected, roots=roots,
+                              jobs=options.jobs, backup_path=backup_path)
         except homefiles.HomefilesException as e:
             utils.error(e)
             sys.exit(1)
+        if roots is not None:
+            report_roots(results)
+    elif cmd == 'status':
+        try:
+            status = hf.status()
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+        if options.json:
+            events.emit('status', consistent=status.consistent,
+                        missing=status.missing, broken=status.broken,
+                        wrong_target=status.wrong_target,
+                        blocked=status.blocked, outdated=status.outdated,
+                        uncommitted_changes=status.uncommitted_changes,
+                        commits_ahead=status.commits_ahead)
+        else:
+            for line in status.describe():
+                print line
+        if not status.consistent:
+            sys.exit(1)
     elif cmd == 'sync':
         try:
             message = args[1]
         except IndexError:
             message = 'Sync'
-        hf.sync(message=message)
-    elif cmd == 'track':
         try:
-            path = args[1]
-        except IndexError:
+            hf.sync(message=message)
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+    elif cmd == 'track':
+        paths = args[1:]
+        if not paths:
             print >> sys.stderr, usage()
             sys.exit(1)
-        hf.track(path, bundle=options.bundle)
+        try:
+            hf.track(paths, bundle=options.bundle)
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+    elif cmd == 'tree':
+        if options.bundle:
+            selected = [s.strip() for s in options.bundle.split(',')]
+        else:
+            selected = None
+
+        try:
+            overlay = hf.overlay(selected=selected)
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+        if options.json:
+            emit_tree(overlay)
+        else:
+            print_tree(overlay)
     elif cmd == 'unlink':
         try:
-            hf.unlink()
+            results = hf.unlink(roots=roots, jobs=options.jobs)
         except homefiles.HomefilesException as e:
             utils.error(e)
             sys.exit(1)
+        if roots is not None:
+            report_roots(results)
     elif cmd == 'untrack':
         try:
             path = args[1]
         except IndexError:
             print >> sys.stderr, usage()
             sys.exit(1)
-        hf.untrack(path)
+        try:
+            hf.untrack(path)
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+    elif cmd == 'watch':
+        # Let a service manager stop us the same way as ^C, so pending
+        # edits still get committed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            hf.watch()
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+    elif cmd == 'which':
+        paths = args[1:]
+        if not paths:
+            print >> sys.stderr, usage()
+            sys.exit(1)
+
+        if options.bundle:
+            selected = [s.strip() for s in options.bundle.split(',')]
+        else:
+            selected = None
+
+        try:
+            nodes = hf.which(paths, selected=selected)
+        except homefiles.HomefilesException as e:
+            utils.error(e)
+            sys.exit(1)
+
+        found = True
+        for path, node in zip(paths, nodes):
+            if options.json:
+                if node is None:
+                    events.emit('which', path=path, found=False)
+                    found = False
+                else:
+                    fields = node_fields(node)
+                    fields['relpath'] = fields.pop('path')
+                    events.emit('which', path=path, found=True, **fields)
+                continue
+
+            if len(paths) > 1:
+                print '%s:' % path
+            if node is None:
+                utils.error("'%s' isn't supplied by any bundle" % path)
+                found = False
+            else:
+                print_suppliers(node)
+        if not found:
+            sys.exit(1)
     else:
         print >> sys.stderr, "error: Unrecognized command '%s'" % cmd
         print >> sys.stderr, usage()
@@ -0,0 +1,382 @@
+"""Plan/apply engine for link, unlink and track.
+
+Planning looks at the desired state and a single `lstat` of each destination
+(shared with the helpers through `utils.stat_cache`) and produces a list of
+typed operations without touching the filesystem. Applying a plan hands each
+operation to the matching `utils` helper in directory order. A dry-run only
+needs to print the plan.
+"""
+import os
+import stat
+import time
+
+import events
+import profiling
+import utils
+
+
+MKDIR = 'mkdir'
+SYMLINK = 'symlink'
+REPLACE = 'replace'
+COPY = 'copy'
+HARDLINK = 'hardlink'
+PULL = 'pull'
+RENAME = 'rename'
+REMOVE = 'remove'
+DELETE = 'delete'
+RMDIR = 'rmdir'
+SKIP = 'skip'
+CONFLICT = 'conflict'
+
+# Orders in which a plan's operations can be applied
+DIRECTORY_ORDER = 'directory'
+REVERSE_DIRECTORY_ORDER = 'reverse-directory'
+SEQUENTIAL_ORDER = 'sequential'
+
+
+class Operation(object):
+    def __init__(self, kind, path, source=None, bundle=None, reason=None,
+                 existing=None):
+        self.kind = kind
+        self.path = path
+        self.source = source
+        self.bundle = bundle
+        self.reason = reason
+        # For skips, what is already at `path` ('symlink', 'directory',
+        # 'copy' or 'hardlink'); for pulls, how `path` was deployed
+        self.existing = existing
+
+    def __str__(self):
+        if self.kind in (SYMLINK, REPLACE, COPY, HARDLINK, RENAME):
+            desc = "%-8s '%s' -> '%s'" % (self.kind, self.source, self.path)
+        else:
+            desc = "%-8s '%s'" % (self.kind, self.path)
+
+        details = [d for d in (self.bundle, self.reason) if d]
+        if details:
+            desc += ' (%s)' % ', '.join(details)
+        return desc
+
+
+class Plan(object):
+    def __init__(self, order=DIRECTORY_ORDER):
+        self.order = order
+        self.operations = []
+
+    def add(self, kind, path, **kwargs):
+        operation = Operation(kind, path, **kwargs)
+        self.operations.append(operation)
+        return operation
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    @property
+    def conflicts(self):
+        return [op for op in self.operations if op.kind == CONFLICT]
+
+    def ordered(self):
+        if self.order == SEQUENTIAL_ORDER:
+            return list(self.operations)
+
+        # Sorting on path components puts every directory before its
+        # contents; the sort is stable so same-path operations keep their
+        # planned order
+        reverse = self.order == REVERSE_DIRECTORY_ORDER
+        return sorted(self.operations, key=lambda op: op.path.split('/'),
+                      reverse=reverse)
+
+    def describe(self):
+        return [str(op) for op in self.ordered()]
+
+
+def _plan_deployed(plan, kind, source, dst_path, st, bundle, is_stale_link,
+                   hashes):
+    """Plan a file deployed as a copy or a hard link.
+
+    Contents are compared by digest against each other and against what was
+    last deployed, to tell whether the repo or the root changed since.
+    """
+    if st is None:
+        plan.add(kind, dst_path, source=source, bundle=bundle)
+        return
+
+    if stat.S_ISLNK(st.st_mode):
+        if is_stale_link(dst_path, None):
+            plan.add(kind, dst_path, source=source, bundle=bundle)
+        else:
+            plan.add(CONFLICT, dst_path, source=source, bundle=bundle,
+                     reason="'%s' is a symlink. Remove it before deploying "
+                            "a %s." % (dst_path, kind))
+        return
+
+    if not stat.S_ISREG(st.st_mode):
+        plan.add(CONFLICT, dst_path, source=source, bundle=bundle,
+                 reason="'%s' is not a regular file. Remove it before "
+                        "deploying a %s." % (dst_path, kind))
+        return
+
+    src_st = utils.lstat(source)
+    if kind == HARDLINK and (src_st.st_dev, src_st.st_ino) == \
+            (st.st_dev, st.st_ino):
+        plan.add(SKIP, dst_path, source=source, bundle=bundle, existing=kind)
+        return
+
+    src_digest = hashes.digest(source, src_st)
+    dst_digest = hashes.digest(dst_path, st)
+    deployed = hashes.deployed(dst_path)
+
+    if src_digest == dst_digest:
+        if kind == HARDLINK:
+            plan.add(HARDLINK, dst_path, source=source, bundle=bundle)
+        else:
+            plan.add(SKIP, dst_path, source=source, bundle=bundle,
+                     existing=kind)
+    elif dst_digest == deployed:
+        plan.add(kind, dst_path, source=source, bundle=bundle,
+                 reason='changed in repo')
+    elif src_digest == deployed:
+        plan.add(PULL, dst_path, source=source, bundle=bundle,
+                 existing=kind, reason='changed in root')
+    else:
+        plan.add(CONFLICT, dst_path, source=source, bundle=bundle,
+                 reason="'%s' and '%s' have both changed since it was "
+                        "deployed." % (dst_path, source))
+
+
+def plan_link(entries, root_path, repo_path=None, hashes=None):
+    """Plan the links for `entries`, an iterable of
+    (kind, source, relpath, bundle) tuples ordered from most to least
+    specific bundle, where kind is 'directory', 'symlink', 'copy' or
+    'hardlink'. Copies and hard links need a `deploy.HashCache`.
+
+    When `repo_path` is given, existing links into it that point at the
+    wrong source are retargeted in place; links pointing anywhere else are
+    left alone.
+    """
+    repo_prefix = repo_path and repo_path.rstrip('/') + '/'
+
+    def is_stale_link(path, source):
+        if not repo_prefix:
+            return False
+        target = os.readlink(path)
+        return target != source and target.startswith(repo_prefix)
+
+    plan = Plan()
+    claimed = {}
+    planned_dirs = set()
+
+    for kind, source, relpath, bundle in entries:
+        dst_path = os.path.join(root_path, relpath)
+
+        if dst_path in claimed:
+            plan.add(SKIP, dst_path, source=source, bundle=bundle,
+                     reason="shadowed by '%s'" % claimed[dst_path])
+            continue
+        claimed[dst_path] = bundle
+
+        # Nothing can exist beneath a directory we are about to create
+        if os.path.dirname(dst_path) in planned_dirs:
+            st = None
+        else:
+            st = utils.lstat(dst_path)
+
+        if kind == 'directory':
+            if st is not None and stat.S_ISLNK(st.st_mode) and \
+                    is_stale_link(dst_path, None):
+                # Used to be a tracked directory; its contents must not end
+                # up inside the repo
+                plan.add(REMOVE, dst_path, bundle=bundle)
+                st = None
+
+            if st is None:
+                plan.add(MKDIR, dst_path, bundle=bundle)
+                planned_dirs.add(dst_path)
+            elif utils.isdir(dst_path):
+                plan.add(SKIP, dst_path, bundle=bundle, existing='directory')
+            else:
+                plan.add(CONFLICT, dst_path, bundle=bundle,
+                         reason="'%s' is not a directory. Remove file "
+                                "before linking." % dst_path)
+        elif kind in (COPY, HARDLINK):
+            _plan_deployed(plan, kind, source, dst_path, st, bundle,
+                           is_stale_link, hashes)
+        elif st is None:
+            plan.add(SYMLINK, dst_path, source=source, bundle=bundle)
+        elif stat.S_ISLNK(st.st_mode):
+            if is_stale_link(dst_path, source):
+                plan.add(REPLACE, dst_path, source=source, bundle=bundle)
+            else:
+                plan.add(SKIP, dst_path, source=source, bundle=bundle,
+                         existing='symlink')
+        else:
+            plan.add(CONFLICT, dst_path, source=source, bundle=bundle,
+                     reason="'%s' is not a symlink. Remove file before "
+                            "linking." % dst_path)
+
+    return plan
+
+
+def plan_unlink(entries, hashes=None):
+    """Plan the removal of `entries`, an iterable of (bundle, kind, path)
+    tuples ordered children before parents. Directories are only removed
+    once nothing but planned removals is left in them, and copies only if
+    they haven't been changed since they were deployed.
+    """
+    plan = Plan(order=REVERSE_DIRECTORY_ORDER)
+    removed = set()
+
+    for bundle, kind, path in entries:
+        if path in removed:
+            continue
+
+        st = utils.lstat(path)
+        if st is None:
+            plan.add(SKIP, path, bundle=bundle, reason='missing')
+        elif kind == 'symlink':
+            if stat.S_ISLNK(st.st_mode):
+                plan.add(REMOVE, path, bundle=bundle)
+                removed.add(path)
+            else:
+                plan.add(CONFLICT, path, bundle=bundle,
+                         reason="'%s' is not a symlink. Remove file before "
+                                "unlinking." % path)
+        elif kind in (COPY, HARDLINK):
+            if not stat.S_ISREG(st.st_mode):
+                plan.add(SKIP, path, bundle=bundle, reason='replaced')
+            elif (kind == HARDLINK and st.st_nlink > 1) or \
+                    hashes.digest(path, st) == hashes.deployed(path):
+                # A hard link still shared with the repo loses nothing
+                plan.add(DELETE, path, bundle=bundle, existing=kind)
+                removed.add(path)
+            else:
+                plan.add(CONFLICT, path, bundle=bundle,
+                         reason="'%s' has changed since it was deployed. "
+                                "Link again to pull the changes into the "
+                                "repo first." % path)
+        elif kind == 'directory' and stat.S_ISDIR(st.st_mode):
+            remaining = [name for name in os.listdir(path)
+                         if os.path.join(path, name) not in removed]
+            if remaining:
+                plan.add(SKIP, path, bundle=bundle, reason='not empty')
+            else:
+                plan.add(RMDIR, path, bundle=bundle)
+                removed.add(path)
+
+    return plan
+
+
+def plan_track(moves):
+    """Plan moving each (src_path, dst_path, bundle) in `moves` into the repo
+    and linking it back into place.
+    """
+    plan = Plan(order=SEQUENTIAL_ORDER)
+    planned_dirs = set()
+
+    for src_path, dst_path, bundle in moves:
+        for dirpath in utils.parent_directories(dst_path):
+            if dirpath not in planned_dirs and utils.lstat(dirpath) is None:
+                plan.add(MKDIR, dirpath, bundle=bundle)
+                planned_dirs.add(dirpath)
+
+        if utils.lstat(dst_path) is not None:
+            plan.add(CONFLICT, dst_path, bundle=bundle,
+                     reason="'%s' is already tracked" % dst_path)
+            continue
+
+        plan.add(RENAME, dst_path, source=src_path, bundle=bundle)
+        plan.add(SYMLINK, src_path, source=dst_path, bundle=bundle)
+
+    return plan
+
+
+def plan_backup(paths, root_path, backup_path):
+    """Plan moving each of `paths` in the way of a link into `backup_path`,
+    keeping their layout relative to `root_path`.
+    """
+    plan = Plan(order=SEQUENTIAL_ORDER)
+    planned_dirs = set()
+    moved = []
+
+    for path in sorted(paths):
+        # Moves along with its parent
+        if any(path.startswith(other + '/') for other in moved):
+            continue
+        moved.append(path)
+
+        dst_path = os.path.join(backup_path, utils.relpath(root_path, path))
+        for dirpath in utils.parent_directories(dst_path):
+            if dirpath not in planned_dirs and utils.lstat(dirpath) is None:
+                plan.add(MKDIR, dirpath)
+                planned_dirs.add(dirpath)
+
+        if utils.lstat(dst_path) is not None:
+            plan.add(CONFLICT, path,
+                     reason="'%s' is already backed up at '%s'"
+                            % (path, dst_path))
+            continue
+
+        plan.add(RENAME, dst_path, source=path)
+
+    return plan
+
+
+def _apply_operation(op, dry_run=False, undo_log=None):
+    if op.kind == MKDIR:
+        utils.mkdir(op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == SYMLINK:
+        utils.symlink(op.source, op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == REPLACE:
+        utils.replace_symlink(op.source, op.path, dry_run=dry_run,
+                              undo_log=undo_log)
+    elif op.kind == COPY:
+        utils.copy_file(op.source, op.path, dry_run=dry_run,
+                        undo_log=undo_log)
+    elif op.kind == HARDLINK:
+        utils.hardlink(op.source, op.path, dry_run=dry_run,
+                       undo_log=undo_log)
+    elif op.kind == PULL:
+        if op.existing == HARDLINK:
+            utils.hardlink(op.path, op.source, dry_run=dry_run,
+                           undo_log=undo_log)
+        else:
+            utils.copy_file(op.path, op.source, dry_run=dry_run,
+                            undo_log=undo_log)
+    elif op.kind == DELETE:
+        utils.remove_file(op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == RENAME:
+        utils.rename(op.source, op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == REMOVE:
+        utils.remove_symlink(op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == RMDIR:
+        utils.rmdir(op.path, dry_run=dry_run, undo_log=undo_log)
+    elif op.kind == CONFLICT:
+        raise utils.NotASymlink(op.reason)
+
+
+def apply(plan, dry_run=False, undo_log=None, label='apply'):
+    """Apply a plan's operations in order, recording undo callbacks.
+
+    When profiling, time spent is attributed to "<label> '<bundle>'".
+    """
+    try:
+        for op in plan.ordered():
+            if events.ENABLED:
+                events.set_context(bundle=op.bundle)
+
+            if not profiling.ENABLED:
+                _apply_operation(op, dry_run=dry_run, undo_log=undo_log)
+                continue
+
+            start = time.time()
+            try:
+                _apply_operation(op, dry_run=dry_run, undo_log=undo_log)
+            finally:
+                profiling.add_time("%s '%s'" % (label, op.bundle),
+                                   time.time() - start)
+    finally:
+        if events.ENABLED:
+            events.set_context()
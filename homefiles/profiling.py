@@ -0,0 +1,89 @@
+"""Per-phase wall times and operation counters for `--profile`.
+
+Everything here is a no-op until ENABLED is set, so the hooks sprinkled
+through `utils`, `git` and `Homefiles` cost next to nothing normally.
+"""
+import contextlib
+import functools
+import json
+import sys
+import time
+
+
+ENABLED = False
+
+_START = time.time()
+_PHASE_ORDER = []
+_PHASES = {}
+_COUNTERS = {}
+
+
+def enable():
+    global ENABLED, _START
+    ENABLED = True
+    _START = time.time()
+
+
+def count(name, n=1):
+    if ENABLED:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+
+
+def add_time(name, seconds):
+    if not ENABLED:
+        return
+
+    try:
+        totals = _PHASES[name]
+    except KeyError:
+        totals = _PHASES[name] = {'seconds': 0.0, 'calls': 0}
+        _PHASE_ORDER.append(name)
+
+    totals['seconds'] += seconds
+    totals['calls'] += 1
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block; repeated phases are summed."""
+    if not ENABLED:
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_time(name, time.time() - start)
+
+
+def timed(name):
+    """Decorator timing every call to a function as phase `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    phases = []
+    for name in _PHASE_ORDER:
+        totals = _PHASES[name]
+        phases.append({'name': name,
+                       'seconds': round(totals['seconds'], 6),
+                       'calls': totals['calls']})
+
+    return {'total_seconds': round(time.time() - _START, 6),
+            'phases': phases,
+            'counters': dict(_COUNTERS)}
+
+
+def write_report(stream=None):
+    if not ENABLED:
+        return
+
+    stream = stream or sys.stderr
+    stream.write(json.dumps(report(), sort_keys=True) + '\n')
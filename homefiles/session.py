@@ -0,0 +1,180 @@
+"""A long-lived, in-process way to drive homefiles.
+
+`Session` keeps one `Homefiles`, with its git wrapper, tracked-directory
+index, platform detection and rule files, warm between calls, so a
+configuration-management agent can call `link`, `status`, `track` and
+`sync` repeatedly without paying for start-up each time:
+
+    session = Session()
+    session.link()
+    if not session.status().consistent:
+        ...
+
+Before each call the repo is compared, with a handful of stats, against how
+it was left after the previous one, and everything cached is dropped if
+another process changed it in between. Failures are raised as
+`homefiles.HomefilesException` and nothing ever prompts.
+"""
+import functools
+import os
+
+import deploy
+import homefiles
+import ignore
+import template
+import utils
+
+
+DEFAULT_REMOTE_REPO = '.homefiles'
+DEFAULT_REPO = '~/.homefiles'
+DEFAULT_ROOT = '~'
+
+
+def _flag(name):
+    return os.getenv(name, '') not in ('', '0')
+
+
+def options_from_environment():
+    """`Homefiles` keyword arguments from the HOMEFILES_* variables."""
+    return {
+        'root_path': utils.truepath(os.getenv('HOMEFILES_ROOT') or
+                                    DEFAULT_ROOT),
+        'repo_path': utils.truepath(os.getenv('HOMEFILES_REPO') or
+                                    DEFAULT_REPO),
+        'remote_repo': os.getenv('HOMEFILES_REMOTE_REPO') or
+                       DEFAULT_REMOTE_REPO,
+        'collapse_directories': _flag('HOMEFILES_COLLAPSE'),
+        'use_git_index': _flag('HOMEFILES_USE_GIT_INDEX'),
+    }
+
+
+def _call(method):
+    """Run a session method with fresh-enough caches, one at a time, turning
+    every failure into a HomefilesException.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        # Imported here since main imports this module for every command,
+        # and read-only ones like `bundles` never load the git wrapper
+        import git
+        with self._lock:
+            self._refresh()
+            try:
+                return method(self, *args, **kwargs)
+            except homefiles.HomefilesException:
+                raise
+            except (git.GitException, git.ProcessException) as e:
+                raise homefiles.GitCommandFailed(str(e) or
+                                                 e.__class__.__name__)
+            except (EnvironmentError, utils.UtilException) as e:
+                raise homefiles.FilesystemError(str(e))
+            finally:
+                self._fingerprint = self._take_fingerprint()
+    return wrapper
+
+
+class Session(object):
+    """Keyword arguments are those of `Homefiles`; any not given come from
+    the HOMEFILES_* environment variables as for the command line.
+    """
+    def __init__(self, **options):
+        # Imported here since main imports this module for every command
+        import threading
+
+        settings = options_from_environment()
+        settings.update(options)
+        self.homefiles = homefiles.Homefiles(**settings)
+        self._lock = threading.Lock()
+        self._fingerprint = self._take_fingerprint()
+
+    def _take_fingerprint(self):
+        """Stats of the files any change to the repo, by git or by hand at
+        the top level, would touch, and of this machine's release files.
+        """
+        repo_path = self.homefiles.repo_path
+        git_dir = os.path.join(repo_path, '.git')
+        paths = [repo_path,
+                 os.path.join(repo_path, ignore.IGNORE_FILENAME),
+                 os.path.join(repo_path, deploy.DEPLOY_FILENAME),
+                 os.path.join(repo_path, template.VARS_FILENAME),
+                 os.path.join(git_dir, 'index'),
+                 os.path.join(git_dir, 'HEAD'),
+                 os.path.join(git_dir, 'packed-refs'),
+                 self.homefiles.hash_cache.path,
+                 self.homefiles.templates.keys_path]
+
+        try:
+            with open(os.path.join(git_dir, 'HEAD')) as f:
+                head = f.read().strip()
+        except IOError:
+            head = ''
+        if head.startswith('ref: '):
+            paths.append(os.path.join(git_dir, head[len('ref: '):]))
+
+        # The detected platforms are kept in memory, so they'd otherwise
+        # never be detected again
+        fingerprint = [self.homefiles.platform_state.key()]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                fingerprint.append(None)
+            else:
+                fingerprint.append((st.st_ino, st.st_size, st.st_mtime))
+        return fingerprint
+
+    def _refresh(self):
+        if self._take_fingerprint() != self._fingerprint:
+            self.homefiles.invalidate()
+        else:
+            # A .trackeddir added or removed below the top of the repo
+            # changes nothing the fingerprint stats; the index is only
+            # listed again if the call needs it
+            self.homefiles.tracked_directories.invalidate()
+
+    def invalidate(self):
+        """Drop every cache, e.g. after the machine's platform changed."""
+        with self._lock:
+            self.homefiles.invalidate()
+
+    @_call
+    def bundles(self):
+        """Return (matching, non_matching) sets of bundle names."""
+        return self.homefiles.bundle_breakdown()
+
+    @_call
+    def link(self, selected=None, roots=None, jobs=None, backup_path=None):
+        return self.homefiles.link(selected=selected, roots=roots, jobs=jobs,
+                                   backup_path=backup_path)
+
+    @_call
+    def unlink(self, roots=None, jobs=None):
+        return self.homefiles.unlink(roots=roots, jobs=jobs)
+
+    @_call
+    def relink(self):
+        return self.homefiles.relink()
+
+    @_call
+    def status(self):
+        return self.homefiles.status()
+
+    @_call
+    def track(self, paths, bundle=None):
+        return self.homefiles.track(paths, bundle=bundle)
+
+    @_call
+    def untrack(self, path):
+        return self.homefiles.untrack(path)
+
+    @_call
+    def sync(self, message='Sync'):
+        return self.homefiles.sync(message=message, prompt=False)
+
+    @_call
+    def overlay(self, selected=None):
+        return self.homefiles.overlay(selected=selected)
+
+    @_call
+    def which(self, paths, selected=None):
+        return self.homefiles.which(paths, selected=selected)
@@ -0,0 +1,195 @@
+"""Per-host files rendered from templates in bundles.
+
+A bundle file named e.g. `.gitconfig.hftmpl` is rendered with the host's
+variables and linked as `.gitconfig`. `{{ name }}` is replaced by the value
+of variable `name`; naming an undefined variable is an error.
+
+Variables are `hostname`, `user`, `os` and `platform`, plus any set in the
+repo's `.homefilesvars`, an INI file whose `[DEFAULT]` section applies to
+every host and whose other sections apply to the host of that name:
+
+    [DEFAULT]
+    email = me@example.com
+
+    [worklaptop]
+    email = me@example.org
+
+Rendered files live under `.git/homefiles-templates`, and the root links to
+them there. Each remembers a key made from the template's digest and the
+variables, so a file is only rendered again when one of those changes.
+"""
+import os
+import re
+
+import profiling
+import utils
+
+
+TEMPLATE_SUFFIX = '.hftmpl'
+VARS_FILENAME = '.homefilesvars'
+
+VARIABLE_RE = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def host_variables(platforms):
+    """The built-in variables, given the platform bundles for this host."""
+    # Imported here, like in `Homefiles._detect_platforms`, so that only
+    # repos with templates pay for them
+    import getpass
+    import platform
+    import socket
+
+    variables = {
+        'hostname': socket.gethostname().split('.')[0],
+        'user': getpass.getuser(),
+        'os': platform.system(),
+    }
+    if platforms:
+        variables['platform'] = platforms[0][len('OS-'):]
+    return variables
+
+
+def read_variables(path, hostname):
+    """Variables from a .homefilesvars file for the given host."""
+    import ConfigParser
+
+    parser = ConfigParser.RawConfigParser()
+    # Keep variable names as written
+    parser.optionxform = str
+    try:
+        parser.read(path)
+    except ConfigParser.Error as e:
+        raise TemplateError("Unable to read '%s': %s" % (path, e))
+
+    if parser.has_section(hostname):
+        return dict(parser.items(hostname))
+    return parser.defaults()
+
+
+def render(text, variables):
+    def substitute(m):
+        try:
+            return variables[m.group(1)]
+        except KeyError:
+            raise TemplateError("Undefined variable '%s'" % m.group(1))
+
+    return VARIABLE_RE.sub(substitute, text)
+
+
+class TemplateRenderer(object):
+    """Renders templates into the cache under .git, skipping those whose
+    template and variables haven't changed since they were last rendered.
+    """
+    def __init__(self, repo_path, hashes, builtins, dry_run=False):
+        self.repo_path = repo_path
+        self.cache_path = os.path.join(repo_path, '.git',
+                                       'homefiles-templates')
+        self.keys_path = os.path.join(repo_path, '.git',
+                                      'homefiles-rendered')
+        self.hashes = hashes
+        self._builtins = builtins
+        self.dry_run = dry_run
+        self._variables = None
+        self._variables_digest = None
+        self._keys = None
+        self._dirty = False
+
+    def reset(self):
+        """Read the variables again, e.g. after .homefilesvars changed."""
+        self._variables = None
+        self._variables_digest = None
+
+    def invalidate(self):
+        """Like `reset`, and read the record of what was rendered again
+        too.
+        """
+        self.reset()
+        self._keys = None
+        self._dirty = False
+
+    def _load_variables(self):
+        import hashlib
+
+        variables = self._builtins()
+        path = os.path.join(self.repo_path, VARS_FILENAME)
+        if os.path.exists(path):
+            variables.update(read_variables(path, variables['hostname']))
+
+        digest = hashlib.sha1()
+        for name, value in sorted(variables.items()):
+            digest.update('%s=%s\0' % (name, value))
+
+        self._variables = variables
+        self._variables_digest = digest.hexdigest()
+
+    def _load_keys(self):
+        self._keys = {}
+        if not os.path.exists(self.keys_path):
+            return
+
+        with open(self.keys_path) as f:
+            for line in f:
+                path, key = line.rstrip('\n').split('\t', 1)
+                self._keys[path] = key
+
+    def output_path(self, bundle, relpath):
+        return os.path.join(self.cache_path, bundle, relpath)
+
+    def is_rendered(self, path):
+        return path.startswith(self.cache_path + '/')
+
+    def render(self, template_path, bundle, relpath):
+        """Render a template for the bundle-relative `relpath` it provides,
+        returning the path of the result.
+        """
+        output = self.output_path(bundle, relpath)
+        if self.dry_run:
+            return output
+
+        if self._variables_digest is None:
+            self._load_variables()
+        if self._keys is None:
+            self._load_keys()
+
+        import hashlib
+        key = hashlib.sha1('%s\0%s' % (self.hashes.digest(template_path),
+                                       self._variables_digest)).hexdigest()
+        if self._keys.get(output) == key and os.path.exists(output):
+            return output
+
+        utils.log("Rendering '%s'" % template_path)
+        profiling.count('render')
+        with open(template_path) as f:
+            try:
+                text = render(f.read(), self._variables)
+            except TemplateError as e:
+                raise TemplateError("'%s': %s" % (template_path, e))
+
+        dirpath = os.path.dirname(output)
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        # Written aside and renamed so links never see a partial file, and
+        # read-only since edits belong in the template
+        tmp_name = '%s.homefiles-%d' % (output, os.getpid())
+        with open(tmp_name, 'w') as f:
+            f.write(text)
+        os.chmod(tmp_name, os.stat(template_path).st_mode & 0555)
+        os.rename(tmp_name, output)
+
+        self._keys[output] = key
+        self._dirty = True
+        return output
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        with open(self.keys_path, 'w') as f:
+            for path, key in sorted(self._keys.items()):
+                f.write('%s\t%s\n' % (path, key))
+        self._dirty = False
@@ -1,6 +1,17 @@
+import contextlib
+import functools
 import os
+import stat
 import sys
 
+import events
+import profiling
+
+# Set by `load_scandir` on first use, since the backport brings in ctypes,
+# subprocess and more that commands which never walk the repo don't need
+scandir = None
+_scandir_loaded = False
+
 LOG_VERBOSE = False
 
 
@@ -12,11 +23,137 @@ class NotASymlink(UtilException):
     pass
 
 
+class StatCache(object):
+    """Holds one `lstat` result per path (None if missing) so that checking
+    and then changing a path costs a single syscall.
+    """
+    def __init__(self):
+        self._stats = {}
+        # Cached paths by parent directory, so that replacing a directory or
+        # a link to one also drops what was looked up through it
+        self._children = {}
+
+    def _store(self, path, st):
+        self._stats[path] = st
+        self._children.setdefault(os.path.dirname(path), set()).add(path)
+
+    def _forget_beneath(self, path):
+        stack = [path]
+        while stack:
+            for child in self._children.pop(stack.pop(), ()):
+                self._stats.pop(child, None)
+                stack.append(child)
+
+    def lstat(self, path):
+        try:
+            return self._stats[path]
+        except KeyError:
+            pass
+
+        profiling.count('stat')
+        try:
+            st = os.lstat(path)
+        except OSError:
+            st = None
+
+        self._store(path, st)
+        return st
+
+    def forget(self, path):
+        self._stats.pop(path, None)
+        self._forget_beneath(path)
+
+    def removed(self, path):
+        self._store(path, None)
+        self._forget_beneath(path)
+
+
+_STAT_CACHE = None
+
+
+@contextlib.contextmanager
+def stat_cache():
+    """Share one StatCache among all helpers for the enclosed operation.
+
+    Nested uses share the outermost cache.
+    """
+    global _STAT_CACHE
+    outer = _STAT_CACHE
+    if outer is None:
+        _STAT_CACHE = StatCache()
+    try:
+        yield _STAT_CACHE
+    finally:
+        _STAT_CACHE = outer
+
+
+def cache_stats(func):
+    """Decorator running `func` inside a `stat_cache`."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with stat_cache():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def lstat(path):
+    """Return the `lstat` result for `path`, or None if it doesn't exist."""
+    if _STAT_CACHE is not None:
+        return _STAT_CACHE.lstat(path)
+
+    profiling.count('stat')
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def lexists(path):
+    return lstat(path) is not None
+
+
+def islink(path):
+    st = lstat(path)
+    return st is not None and stat.S_ISLNK(st.st_mode)
+
+
+def isdir(path):
+    """Like `os.path.isdir`, following symlinks."""
+    st = lstat(path)
+    if st is None:
+        return False
+    if stat.S_ISLNK(st.st_mode):
+        return os.path.isdir(path)
+    return stat.S_ISDIR(st.st_mode)
+
+
+def _forget(path):
+    if _STAT_CACHE is not None:
+        _STAT_CACHE.forget(path)
+
+
+def _removed(path):
+    if _STAT_CACHE is not None:
+        _STAT_CACHE.removed(path)
+
+
 def capitalize_first_letter(s):
     return s[0].capitalize() + s[1:]
 
 
-def log(msg, newline=True):
+def log(msg, newline=True, op=None, src=None, dst=None):
+    """Print progress when verbose.
+
+    A message naming an `op` announces an operation; the next message
+    completes it with its result, e.g. "[DONE]", and with `--json` the two
+    become a single event.
+    """
+    if events.ENABLED:
+        if op is not None:
+            events.begin(op, msg, src=src, dst=dst)
+        elif not newline or not events.finish(msg.strip('[]').lower()):
+            events.emit('log', message=msg)
+
     if not LOG_VERBOSE:
         return
 
@@ -27,10 +164,18 @@ def log(msg, newline=True):
 
 
 def error(msg):
+    if events.ENABLED:
+        # e.g. every path in the way, from homefiles.Conflicts
+        paths = getattr(msg, 'paths', None)
+        if paths:
+            events.emit('error', message=str(msg), paths=paths)
+        else:
+            events.emit('error', message=str(msg))
     print >> sys.stderr, 'ERROR: %s ' % msg
 
 
 def warn(msg):
+    events.emit('warning', message=str(msg))
     print >> sys.stderr, 'WARNING: %s ' % msg
 
 
@@ -46,21 +191,28 @@ def relpath(base_path, dirpath):
 
 
 def symlink(source, link_name, dry_run=False, undo_log=None):
-    log("Symlinking '%s' -> '%s'" % (source, link_name), newline=False)
+    """Create a symlink, returning False if one was already present."""
+    log("Symlinking '%s' -> '%s'" % (source, link_name), newline=False,
+        op='symlink', src=source, dst=link_name)
 
-    exists = os.path.exists(link_name)
+    # lstat so that dangling symlinks, e.g. ones whose source was just
+    # removed by a pull, are still seen
+    st = lstat(link_name)
 
-    if exists and not os.path.islink(link_name):
+    if st is not None and not stat.S_ISLNK(st.st_mode):
+        log("[FAILED]")
         raise NotASymlink("'%s' is not a symlink. Remove file before linking."
                           % link_name)
 
-    if exists:
+    if st is not None:
         log("[SKIPPED]")
-        return
+        return False
 
     try:
         if not dry_run:
+            profiling.count('symlink')
             os.symlink(source, link_name)
+            _forget(link_name)
     except:
         log("[FAILED]")
         raise
@@ -68,22 +220,238 @@ def symlink(source, link_name, dry_run=False, undo_log=None):
         _add_undo_callback(
             undo_log, lambda: remove_symlink(link_name, dry_run=dry_run))
         log("[DONE]")
+        return True
 
 
-def mkdir(path, dry_run=False, undo_log=None):
-    log("Creating directory '%s'" % path, newline=False)
-    if os.path.exists(path):
+def replace_symlink(source, link_name, dry_run=False, undo_log=None):
+    """Point `link_name` at `source` in a single step.
+
+    The new link is created under a temporary name next to the old one and
+    renamed over it, so there is never a moment where `link_name` is
+    missing. Returns False if it already pointed at `source`.
+    """
+    log("Retargeting symlink '%s' -> '%s'" % (source, link_name),
+        newline=False, op='replace', src=source, dst=link_name)
+
+    st = lstat(link_name)
+    if st is not None and not stat.S_ISLNK(st.st_mode):
+        log("[FAILED]")
+        raise NotASymlink("'%s' is not a symlink. Remove file before linking."
+                          % link_name)
+
+    old_source = os.readlink(link_name) if st is not None else None
+    if old_source == source:
+        log("[SKIPPED]")
+        return False
+
+    try:
+        if not dry_run:
+            tmp_name = '%s.homefiles-%d' % (link_name, os.getpid())
+            profiling.count('symlink')
+            os.symlink(source, tmp_name)
+            try:
+                profiling.count('rename')
+                os.rename(tmp_name, link_name)
+            except:
+                os.unlink(tmp_name)
+                raise
+            _forget(link_name)
+    except:
+        log("[FAILED]")
+        raise
+    else:
+        if old_source is None:
+            _add_undo_callback(
+                undo_log, lambda: remove_symlink(link_name, dry_run=dry_run))
+        else:
+            _add_undo_callback(
+                undo_log, lambda: replace_symlink(old_source, link_name,
+                                                  dry_run=dry_run))
+        log("[DONE]")
+        return True
+
+
+def _replace_with(make, dest):
+    """Create a file under a temporary name next to `dest` with
+    `make(tmp_name)` and rename it into place.
+    """
+    tmp_name = '%s.homefiles-%d' % (dest, os.getpid())
+    make(tmp_name)
+    try:
+        profiling.count('rename')
+        os.rename(tmp_name, dest)
+    except:
+        os.unlink(tmp_name)
+        raise
+    _forget(dest)
+
+
+def copy_file(source, dest, dry_run=False, undo_log=None):
+    """Copy `source` over `dest`, which is never seen half-written.
+
+    Only a newly created `dest` is removed on undo; the contents of one that
+    was replaced are in the repo's history.
+    """
+    log("Copying '%s' -> '%s'" % (source, dest), newline=False, op='copy',
+        src=source, dst=dest)
+    existed = lexists(dest)
+    try:
+        if not dry_run:
+            # Only repos that deploy copies need shutil and everything it
+            # loads
+            import shutil
+            profiling.count('copy')
+            _replace_with(lambda tmp_name: shutil.copy2(source, tmp_name),
+                          dest)
+    except:
+        log("[FAILED]")
+        raise
+    else:
+        if not existed:
+            _add_undo_callback(
+                undo_log, lambda: remove_file(dest, dry_run=dry_run))
+        log("[DONE]")
+
+
+def hardlink(source, link_name, dry_run=False, undo_log=None):
+    """Make `link_name` a hard link to `source`, replacing whatever is there
+    in one step.
+    """
+    log("Hard linking '%s' -> '%s'" % (source, link_name), newline=False,
+        op='hardlink', src=source, dst=link_name)
+    existed = lexists(link_name)
+    try:
+        if not dry_run:
+            profiling.count('link')
+            _replace_with(lambda tmp_name: os.link(source, tmp_name),
+                          link_name)
+    except:
+        log("[FAILED]")
+        raise
+    else:
+        if not existed:
+            _add_undo_callback(
+                undo_log, lambda: remove_file(link_name, dry_run=dry_run))
+        log("[DONE]")
+
+
+def remove_file(path, dry_run=False, undo_log=None):
+    log("Removing file '%s'" % path, newline=False, op='delete', dst=path)
+    st = lstat(path)
+    if st is None:
         log("[SKIPPED]")
         return
+
+    if not stat.S_ISREG(st.st_mode):
+        log("[FAILED]")
+        raise NotASymlink("'%s' is not a regular file." % path)
+
+    if not dry_run:
+        profiling.count('unlink')
+        os.unlink(path)
+        _removed(path)
+    log("[DONE]")
+
+
+def mkdir(path, dry_run=False, undo_log=None):
+    """Create a directory, returning False if it was already present."""
+    log("Creating directory '%s'" % path, newline=False, op='mkdir',
+        dst=path)
+    if lexists(path):
+        log("[SKIPPED]")
+        return False
     try:
         if not dry_run:
+            profiling.count('mkdir')
             os.mkdir(path)
+            _forget(path)
     except:
         log("[FAILED]")
         raise
     else:
         _add_undo_callback(undo_log, lambda: rmdir(path, dry_run=dry_run))
         log("[DONE]")
+        return True
+
+
+class _DirEntry(object):
+    """Minimal stand-in for `os.DirEntry` when scandir is unavailable."""
+    def __init__(self, dirpath, name):
+        self.name = name
+        self.path = os.path.join(dirpath, name)
+        profiling.count('stat')
+        self._lstat = os.lstat(self.path)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self._lstat.st_mode)
+
+    def is_dir(self):
+        if self.is_symlink():
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self._lstat.st_mode)
+
+
+def load_scandir():
+    """Return `scandir` from os or the backport, or None if neither is
+    available.
+    """
+    global scandir, _scandir_loaded
+    if not _scandir_loaded:
+        try:
+            from os import scandir
+        except ImportError:
+            try:
+                from scandir import scandir
+            except ImportError:
+                scandir = None
+        _scandir_loaded = True
+    return scandir
+
+
+def _scandir(path):
+    profiling.count('scandir')
+    if not _scandir_loaded:
+        load_scandir()
+    if scandir is not None:
+        return scandir(path)
+    return [_DirEntry(path, name) for name in os.listdir(path)]
+
+
+def walk(top, skip=None, prune=None):
+    """Top-down replacement for `os.walk` built on scandir.
+
+    `skip(path, is_dir)` drops an entry entirely, while `prune(path)` keeps a
+    directory in its parent's dirnames but never descends into it. Both are
+    decided before descending, and file types come from the directory
+    entries themselves so no extra stat calls are made.
+    """
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            entries = list(_scandir(dirpath))
+        except OSError:
+            continue
+
+        dirnames = []
+        filenames = []
+        descend = []
+        for entry in entries:
+            is_dir = entry.is_dir()
+            if skip is not None and skip(entry.path, is_dir):
+                continue
+            if is_dir:
+                dirnames.append(entry.name)
+                if entry.is_symlink():
+                    continue
+                if prune is None or not prune(entry.path):
+                    descend.append(entry.path)
+            else:
+                filenames.append(entry.name)
+
+        yield dirpath, dirnames, filenames
+
+        stack.extend(reversed(descend))
 
 
 def parent_directories(path):
@@ -100,18 +468,21 @@ def makedirs(path, dry_run=False, undo_log=None):
     paths = parent_directories(path)
     paths.append(path)
     for create_path in paths:
-        if not os.path.exists(create_path):
+        if not lexists(create_path):
             mkdir(create_path, dry_run=dry_run, undo_log=undo_log)
 
 
 def rmdir(path, dry_run=False, undo_log=None):
-    log("Removing directory '%s'" % path, newline=False)
-    if not os.path.exists(path):
+    log("Removing directory '%s'" % path, newline=False, op='rmdir',
+        dst=path)
+    if not lexists(path):
         log("[SKIPPED]")
         return
     try:
         if not dry_run:
+            profiling.count('rmdir')
             os.rmdir(path)
+            _removed(path)
     except:
         log("[FAILED]")
         raise
@@ -133,13 +504,17 @@ def undo_operations(undo_log):
 
 
 def rename(source, dest, dry_run=False, undo_log=None):
-    log("Renaming '%s' -> '%s'" % (source, dest), newline=False)
-    if os.path.exists(dest):
+    log("Renaming '%s' -> '%s'" % (source, dest), newline=False,
+        op='rename', src=source, dst=dest)
+    if lexists(dest):
         log("[SKIPPED]")
         return
     try:
         if not dry_run:
+            profiling.count('rename')
             os.rename(source, dest)
+            _removed(source)
+            _forget(dest)
     except:
         log("[FAILED]")
         raise
@@ -150,19 +525,24 @@ def rename(source, dest, dry_run=False, undo_log=None):
 
 
 def remove_symlink(link_name, dry_run=False, undo_log=None):
-    log("Removing symlink '%s'" % link_name, newline=False)
-    if not os.path.exists(link_name):
+    log("Removing symlink '%s'" % link_name, newline=False, op='remove',
+        dst=link_name)
+    st = lstat(link_name)
+    if st is None:
         log("[SKIPPED]")
         return
 
-    if not os.path.islink(link_name):
+    if not stat.S_ISLNK(st.st_mode):
+        log("[FAILED]")
         raise NotASymlink("'%s' is not a symlink. Remove file before "
                           "unlinking." % link_name)
 
-    source = os.path.realpath(link_name)
+    source = os.readlink(link_name)
 
     if not dry_run:
+        profiling.count('unlink')
         os.unlink(link_name)
+        _removed(link_name)
 
     _add_undo_callback(
         undo_log, lambda: symlink(source, link_name, dry_run=dry_run))
@@ -0,0 +1,306 @@
+"""`homefiles watch`: keep the root linked while files come and go in the
+repo, and commit edits once they have settled.
+
+Changes come from inotify when it is available, through ctypes so there is
+nothing extra to install, and otherwise from comparing snapshots of the repo
+every few seconds. A burst of events is gathered into one batch and handed
+to `Homefiles.relink_paths`, which uses the same `utils` link helpers as
+`link` and `sync`. Links in the root point into the repo, so edits made
+through them show up as changes to the repo and the root itself needs no
+watching.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+import git
+import homefiles
+import utils
+
+
+# Seconds of quiet after the last change before edits are committed
+DEBOUNCE = 30.0
+
+# Seconds to keep gathering events once a burst has started
+SETTLE = 0.2
+
+# Seconds between snapshots when polling
+POLL_INTERVAL = 2.0
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR |
+              IN_DONT_FOLLOW)
+
+# struct inotify_event, followed by `len` bytes of NUL-padded name
+_EVENT = struct.Struct('iIII')
+
+
+class InotifyUnavailable(Exception):
+    pass
+
+
+class Inotify(object):
+    """Just enough of the inotify API to watch directories."""
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError) as e:
+            raise InotifyUnavailable(str(e))
+
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyUnavailable(os.strerror(ctypes.get_errno()))
+
+        self._paths = {}
+
+    def add_watch(self, path):
+        wd = self._add_watch(self.fd, path, WATCH_MASK)
+        if wd >= 0:
+            self._paths[wd] = path
+            return
+
+        err = ctypes.get_errno()
+        # Gone again before we got to it, which is fine
+        if err not in (errno.ENOENT, errno.ENOTDIR):
+            raise OSError(err, os.strerror(err), path)
+
+    def read(self):
+        """Return a (path, mask) pair for each queued event; path is None
+        when events were lost.
+        """
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+            elif mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+            elif wd in self._paths:
+                dirpath = self._paths[wd]
+                events.append((os.path.join(dirpath, name) if name
+                               else dirpath, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class InotifySource(object):
+    """Reports files changed beneath `top`, watching every directory."""
+    def __init__(self, top, skip):
+        self.top = top
+        self.skip = skip
+        self.inotify = Inotify()
+        self._watch_tree(top)
+
+    def _watch_tree(self, top):
+        """Watch `top` and every directory beneath it, returning the files
+        already there, which may have been created before the watch was.
+        """
+        found = []
+        self.inotify.add_watch(top)
+        for dirpath, dirnames, filenames in utils.walk(top, skip=self.skip):
+            for dirname in dirnames:
+                self.inotify.add_watch(os.path.join(dirpath, dirname))
+            found.extend(os.path.join(dirpath, f) for f in filenames)
+        return found
+
+    def reset(self):
+        self.inotify.close()
+        self.inotify = Inotify()
+        self._watch_tree(self.top)
+
+    def wait(self, timeout):
+        """Wait up to `timeout` seconds, or forever if None, for changes.
+
+        Returns the changed file paths, or None if they can't be known and
+        everything should be rechecked.
+        """
+        readable, _, _ = select.select([self.inotify.fd], [], [], timeout)
+        if not readable:
+            return []
+
+        changes = []
+        for path, mask in self.inotify.read():
+            if path is None or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                return None
+
+            is_dir = bool(mask & IN_ISDIR)
+            if self.skip(path, is_dir):
+                continue
+
+            if not is_dir:
+                changes.append(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                changes.extend(self._watch_tree(path))
+            elif mask & IN_MOVED_FROM:
+                # Its watches now report under the wrong path
+                return None
+
+        return changes
+
+
+class PollingSource(object):
+    """Finds changed files by comparing snapshots of `top`, for when
+    inotify is unavailable.
+    """
+    def __init__(self, top, skip, interval=POLL_INTERVAL):
+        self.top = top
+        self.skip = skip
+        self.interval = interval
+        self._snapshot = self._take()
+
+    def _take(self):
+        snapshot = {}
+        for dirpath, dirnames, filenames in utils.walk(self.top,
+                                                       skip=self.skip):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                st = utils.lstat(path)
+                if st is not None:
+                    snapshot[path] = (st.st_ino, st.st_size, st.st_mtime)
+        return snapshot
+
+    def reset(self):
+        self._snapshot = self._take()
+
+    def wait(self, timeout):
+        if timeout is None or timeout > self.interval:
+            timeout = self.interval
+        time.sleep(timeout)
+
+        old, new = self._snapshot, self._take()
+        self._snapshot = new
+        return [path for path in set(old) | set(new)
+                if old.get(path) != new.get(path)]
+
+
+class Watcher(object):
+    def __init__(self, hf, debounce=DEBOUNCE, interval=POLL_INTERVAL):
+        self.hf = hf
+        self.debounce = debounce
+        self._commit_due = None
+
+        git_dir = os.path.join(hf.repo_path, '.git')
+
+        def skip(path, is_dir):
+            return path == git_dir
+
+        try:
+            self.source = InotifySource(hf.repo_path, skip)
+        except (InotifyUnavailable, OSError) as e:
+            utils.warn('inotify unavailable (%s), polling every %ss instead'
+                       % (e, interval))
+            self.source = PollingSource(hf.repo_path, skip, interval=interval)
+
+    def _gather(self, changes):
+        """Keep reading until things go quiet, so that a burst, e.g. an
+        editor saving through a temporary file, is handled once.
+        """
+        while changes is not None:
+            more = self.source.wait(SETTLE)
+            if more is None:
+                return None
+            if not more:
+                break
+            changes.extend(more)
+        return changes
+
+    def handle(self, changes):
+        try:
+            if changes is None:
+                utils.log('Lost track of changes, relinking everything')
+                self.source.reset()
+                self.hf.relink()
+            else:
+                prefix_len = len(self.hf.repo_path) + 1
+                added = set()
+                removed = set()
+                for path in set(changes):
+                    if os.path.lexists(path):
+                        added.add(path[prefix_len:])
+                    else:
+                        removed.add(path[prefix_len:])
+                self.hf.relink_paths(added, removed)
+        except (homefiles.HomefilesException, git.GitException,
+                git.ProcessException) as e:
+            utils.error(e)
+
+        self._commit_due = time.time() + self.debounce
+
+    def commit(self):
+        self._commit_due = None
+
+        try:
+            # Saving a file without changing it only touches its stat info
+            self.hf.git.refresh_index()
+            paths = sorted(self.hf.git.uncommitted_paths())
+            if not paths:
+                return
+
+            if len(paths) == 1:
+                message = "Update '%s'" % paths[0]
+            else:
+                message = 'Update %d files' % len(paths)
+            self.hf.git.commit(all=True, message=message)
+        except (git.GitException, git.ProcessException) as e:
+            utils.error(e)
+
+    def run(self):
+        # Catch up with whatever changed while nobody was watching
+        self.hf.relink()
+
+        try:
+            while True:
+                if self._commit_due is None:
+                    timeout = None
+                else:
+                    timeout = max(0, self._commit_due - time.time())
+
+                changes = self.source.wait(timeout)
+                if changes is None or changes:
+                    self.handle(self._gather(changes))
+                elif self._commit_due is not None and \
+                        time.time() >= self._commit_due:
+                    self.commit()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self._commit_due is not None:
+                self.commit()
@@ -19,7 +19,7 @@ setuptools.setup(
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python :: 2.6'
     ],
-    install_requires=[],
+    install_requires=['scandir'],
     entry_points={
         'console_scripts': ['homefiles = homefiles.main:main']
     }
@@ -0,0 +1,240 @@
+"""Times homefiles operations against synthetic repos.
+
+Run from the top of the source tree:
+
+    python -m tests.benchmark.run --files 500 --output before.json
+    python -m tests.benchmark.run --files 500 --compare before.json
+
+Each operation records its wall time along with how many filesystem calls
+and subprocesses it made, and the results are written as JSON so runs from
+different commits can be compared.
+"""
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import homefiles
+from homefiles import utils
+from tests.benchmark import synthetic
+
+
+COUNTED_OS_FUNCTIONS = [
+    'listdir', 'lstat', 'mkdir', 'readlink', 'rename', 'rmdir', 'stat',
+    'symlink', 'unlink',
+]
+
+
+class Counters(object):
+    """Counts filesystem calls and subprocess spawns while active."""
+    def __init__(self):
+        self.syscalls = {}
+        self.subprocesses = 0
+        self._patched = []
+
+    def _patch(self, module, name, replacement):
+        self._patched.append((module, name, getattr(module, name)))
+        setattr(module, name, replacement)
+
+    def _counting(self, name, func):
+        counts = self.syscalls
+
+        def wrapper(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        for name in COUNTED_OS_FUNCTIONS:
+            self._patch(os, name, self._counting(name, getattr(os, name)))
+
+        if utils.load_scandir() is not None:
+            self._patch(utils, 'scandir',
+                        self._counting('scandir', utils.scandir))
+
+        counters = self
+        popen = subprocess.Popen
+
+        class CountingPopen(popen):
+            def __init__(self, *args, **kwargs):
+                counters.subprocesses += 1
+                popen.__init__(self, *args, **kwargs)
+
+        self._patch(subprocess, 'Popen', CountingPopen)
+        return self
+
+    def __exit__(self, *exc_info):
+        while self._patched:
+            module, name, original = self._patched.pop()
+            setattr(module, name, original)
+
+
+def measure(func):
+    with Counters() as counters:
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+
+    return {
+        'seconds': round(elapsed, 6),
+        'syscalls': counters.syscalls,
+        'subprocesses': counters.subprocesses,
+    }
+
+
+def _quiet(func):
+    """Keep the operation's own stdout/stderr chatter out of the report."""
+    def wrapper():
+        stdout, stderr = sys.stdout, sys.stderr
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = sys.stderr = devnull
+            try:
+                func()
+            finally:
+                sys.stdout, sys.stderr = stdout, stderr
+    return wrapper
+
+
+def run_once(options, base_path):
+    hf_probe = homefiles.Homefiles('/', '/', None)
+    repo = synthetic.SyntheticRepo(
+        base_path, hf_probe._matching_platforms(), bundles=options.bundles,
+        files=options.files, depth=options.depth,
+        tracked_dirs=options.tracked_dirs,
+        tracked_files=options.tracked_files,
+        ignore_patterns=options.ignore_patterns)
+    repo.create()
+
+    def make():
+        return homefiles.Homefiles(repo.root_path, repo.repo_path,
+                                   repo.origin_path)
+
+    custom = [b for b in repo.bundle_names() if make()._is_custom_bundle(b)]
+
+    results = {}
+    results['bundle_breakdown'] = measure(make().bundle_breakdown)
+    results['link'] = measure(_quiet(lambda: make().link(selected=custom)))
+    results['unlink'] = measure(_quiet(lambda: make().unlink(
+        clear_custom_bundle_state=False)))
+
+    _quiet(lambda: make().link(selected=custom))()
+    repo.push_upstream_change(count=options.upstream_files)
+    results['sync'] = measure(_quiet(lambda: make().sync(message='Bench')))
+    return results
+
+
+def _merge(runs):
+    """Keep the fastest run of each operation, as is usual for timings."""
+    merged = {}
+    for run in runs:
+        for name, result in run.items():
+            if name not in merged or \
+                    result['seconds'] < merged[name]['seconds']:
+                merged[name] = result
+    return merged
+
+
+def compare(old, new):
+    lines = []
+    for name in sorted(new['results']):
+        new_result = new['results'][name]
+        old_result = old['results'].get(name)
+        if old_result is None:
+            continue
+
+        def ratio(a, b):
+            return (float(b) / a) if a else float('inf')
+
+        old_syscalls = sum(old_result['syscalls'].values())
+        new_syscalls = sum(new_result['syscalls'].values())
+        lines.append(
+            '%-18s %9.4fs -> %9.4fs (x%.2f)  syscalls %6d -> %6d  '
+            'subprocesses %3d -> %3d' % (
+                name, old_result['seconds'], new_result['seconds'],
+                ratio(old_result['seconds'], new_result['seconds']),
+                old_syscalls, new_syscalls,
+                old_result['subprocesses'], new_result['subprocesses']))
+    return lines
+
+
+def source_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(homefiles.__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--bundles', type='int', default=4,
+                      help='Number of bundles, all selected')
+    parser.add_option('--files', type='int', default=200,
+                      help='Regular files per bundle')
+    parser.add_option('--depth', type='int', default=3,
+                      help='Directory depth files are spread across')
+    parser.add_option('--tracked-dirs', type='int', default=2,
+                      dest='tracked_dirs',
+                      help='.trackeddir subtrees per bundle')
+    parser.add_option('--tracked-files', type='int', default=200,
+                      dest='tracked_files',
+                      help='Files inside each tracked subtree')
+    parser.add_option('--ignore-patterns', type='int', default=10,
+                      dest='ignore_patterns',
+                      help='Patterns in .homefilesignore')
+    parser.add_option('--upstream-files', type='int', default=10,
+                      dest='upstream_files',
+                      help='Files added upstream before the sync')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='Runs per operation; the fastest is kept')
+    parser.add_option('--output', help='Write JSON results to this file')
+    parser.add_option('--compare', help='Compare against earlier results')
+    parser.add_option('--keep', action='store_true', default=False,
+                      help="Don't delete the generated repos")
+
+    options, args = parser.parse_args()
+
+    runs = []
+    for idx in range(options.repeat):
+        base_path = tempfile.mkdtemp(prefix='homefiles-bench-')
+        try:
+            runs.append(run_once(options, base_path))
+        finally:
+            if options.keep:
+                print >> sys.stderr, 'Kept %s' % base_path
+            else:
+                shutil.rmtree(base_path)
+
+    params = dict((name, getattr(options, name)) for name in (
+        'bundles', 'files', 'depth', 'tracked_dirs', 'tracked_files',
+        'ignore_patterns', 'upstream_files', 'repeat'))
+    report = {
+        'revision': source_revision(),
+        'python': sys.version.split()[0],
+        'params': params,
+        'results': _merge(runs),
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(report, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            old = json.load(f)
+        if old['params'] != params:
+            print >> sys.stderr, 'WARNING: comparing runs with different ' \
+                                 'parameters'
+        for line in compare(old, report):
+            print >> sys.stderr, line
+
+
+if __name__ == '__main__':
+    main()
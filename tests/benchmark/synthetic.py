@@ -0,0 +1,120 @@
+"""Generates throwaway homefiles repos for benchmarking."""
+import os
+import subprocess
+
+
+GIT_ENV = {
+    'GIT_AUTHOR_NAME': 'Benchmark',
+    'GIT_AUTHOR_EMAIL': 'benchmark@example.com',
+    'GIT_COMMITTER_NAME': 'Benchmark',
+    'GIT_COMMITTER_EMAIL': 'benchmark@example.com',
+}
+
+
+def git(cwd, *args):
+    env = dict(os.environ, **GIT_ENV)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(('git',) + args, cwd=cwd, env=env,
+                              stdout=devnull, stderr=devnull)
+
+
+def _write(path, data=''):
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(path, 'w') as f:
+        f.write(data)
+
+
+def _nested_dir(idx, depth):
+    """Spread files across `depth` levels of directories."""
+    parts = ['d%d' % ((idx + level) % 4) for level in range(depth)]
+    return os.path.join(*parts) if parts else ''
+
+
+class SyntheticRepo(object):
+    """A repo and root under `base_path` populated according to the knobs.
+
+    `platforms` are the OS- bundle names matching this machine, so that
+    the generated OS bundles are selected just like on a real host.
+    """
+    def __init__(self, base_path, platforms, bundles=4, files=100, depth=3,
+                 tracked_dirs=2, tracked_files=200, ignore_patterns=10):
+        self.base_path = base_path
+        self.repo_path = os.path.join(base_path, 'repo')
+        self.root_path = os.path.join(base_path, 'root')
+        self.origin_path = os.path.join(base_path, 'origin.git')
+        self.other_path = os.path.join(base_path, 'other')
+        self.platforms = platforms
+        self.bundles = bundles
+        self.files = files
+        self.depth = depth
+        self.tracked_dirs = tracked_dirs
+        self.tracked_files = tracked_files
+        self.ignore_patterns = ignore_patterns
+
+    def bundle_names(self):
+        names = ['Default'] + list(self.platforms)
+        idx = 0
+        while len(names) < self.bundles:
+            names.append('Custom%d' % idx)
+            idx += 1
+        return names[:self.bundles]
+
+    def _populate_bundle(self, bundle):
+        bundle_path = os.path.join(self.repo_path, bundle)
+        for idx in range(self.files):
+            dirname = _nested_dir(idx, idx % (self.depth + 1))
+            _write(os.path.join(bundle_path, dirname,
+                                '.%s-file%d' % (bundle, idx)), 'x\n')
+
+            # Files every bundle supplies, so precedence is exercised
+            if idx % 10 == 0:
+                _write(os.path.join(bundle_path, dirname,
+                                    '.shared%d' % idx), bundle)
+
+        for idx in range(self.tracked_dirs):
+            tracked_path = os.path.join(
+                bundle_path, '.%s-tracked%d' % (bundle, idx))
+            _write(os.path.join(tracked_path, '.trackeddir'))
+            for file_idx in range(self.tracked_files):
+                _write(os.path.join(tracked_path,
+                                    _nested_dir(file_idx, self.depth),
+                                    'plugin%d.vim' % file_idx), 'x\n')
+
+        for idx in range(self.ignore_patterns):
+            _write(os.path.join(bundle_path, 'junk%d.ignored%d' % (idx, idx)))
+
+    def create(self):
+        os.makedirs(self.root_path)
+        os.makedirs(self.repo_path)
+        for bundle in self.bundle_names():
+            self._populate_bundle(bundle)
+
+        patterns = ['*.ignored%d' % idx for idx in range(self.ignore_patterns)]
+        _write(os.path.join(self.repo_path, '.homefilesignore'),
+               '\n'.join(patterns) + '\n')
+
+        git(self.repo_path, 'init', '-q', '.')
+        git(self.repo_path, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+        git(self.repo_path, 'config', 'user.name', GIT_ENV['GIT_AUTHOR_NAME'])
+        git(self.repo_path, 'config', 'user.email',
+            GIT_ENV['GIT_AUTHOR_EMAIL'])
+        git(self.repo_path, 'config', 'pull.rebase', 'false')
+        git(self.repo_path, 'add', '-A')
+        git(self.repo_path, 'commit', '-q', '-m', 'Synthetic repo')
+
+        # A local bare remote so `sync` never touches the network
+        git(self.base_path, 'init', '-q', '--bare', self.origin_path)
+        git(self.repo_path, 'remote', 'add', 'origin', self.origin_path)
+        git(self.repo_path, 'push', '-q', 'origin', 'master')
+        git(self.base_path, 'clone', '-q', self.origin_path, self.other_path)
+
+    def push_upstream_change(self, count=10):
+        """Commit `count` new files to the remote from another clone."""
+        for idx in range(count):
+            _write(os.path.join(self.other_path, 'Default', 'upstream',
+                                'new%d' % idx), 'x\n')
+        git(self.other_path, 'add', '-A')
+        git(self.other_path, 'commit', '-q', '-m', 'Upstream change')
+        git(self.other_path, 'push', '-q', 'origin', 'master')
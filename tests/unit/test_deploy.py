@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from homefiles import deploy
+
+
+class DeployRulesTestCase(unittest.TestCase):
+    def assertMode(self, lines, relpath, mode):
+        rules = deploy.DeployRules.from_lines(lines)
+        self.assertEqual(mode, rules.mode(relpath))
+
+    def test_default_is_symlink(self):
+        self.assertMode([], '.vimrc', deploy.SYMLINK)
+
+    def test_file_pattern(self):
+        self.assertMode(['copy *.json'], '.config/app/settings.json',
+                        deploy.COPY)
+
+    def test_directory_applies_beneath(self):
+        self.assertMode(['hardlink .config/app/'], '.config/app/a/b',
+                        deploy.HARDLINK)
+
+    def test_last_match_wins(self):
+        lines = ['copy .config/', 'symlink .config/keep']
+        self.assertMode(lines, '.config/keep', deploy.SYMLINK)
+        self.assertMode(lines, '.config/other', deploy.COPY)
+
+    def test_unknown_mode(self):
+        self.assertRaises(deploy.InvalidDeployRule,
+                          deploy.DeployRules.from_lines, ['move .vimrc'])
+
+    def test_more_rules_than_regex_groups(self):
+        lines = ['copy .config/'] + ['hardlink /file%d' % i
+                                     for i in range(150)]
+        self.assertMode(lines, '.config/app', deploy.COPY)
+        self.assertMode(lines, 'file149', deploy.HARDLINK)
+        self.assertMode(lines, 'other', deploy.SYMLINK)
+
+
+class HashCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        os.mkdir(os.path.join(self.tmpdir, '.git'))
+        self.path = os.path.join(self.tmpdir, 'file')
+        with open(self.path, 'w') as f:
+            f.write('contents')
+        # Old enough not to be racy
+        os.utime(self.path, (1000000000, 1000000000))
+
+    def test_unchanged_file_is_not_read_again(self):
+        cache = deploy.HashCache(self.tmpdir)
+        digest = cache.digest(self.path)
+        cache.set_deployed(self.path, digest)
+        cache.save()
+
+        cache = deploy.HashCache(self.tmpdir)
+        os.chmod(self.path, 0)
+        self.assertEqual(digest, cache.digest(self.path))
+        self.assertEqual(digest, cache.deployed(self.path))
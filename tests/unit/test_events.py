@@ -0,0 +1,39 @@
+import json
+import StringIO
+import unittest
+
+from homefiles import events
+from homefiles import utils
+
+
+class EventsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO.StringIO()
+        events.enable(self.stream)
+        self.addCleanup(setattr, events, 'ENABLED', False)
+
+    def emitted(self):
+        return [json.loads(line)
+                for line in self.stream.getvalue().splitlines()]
+
+    def test_announced_operation_becomes_one_event(self):
+        events.set_context(bundle='Default')
+        self.addCleanup(events.set_context)
+        utils.log("Symlinking 'a' -> 'b'", newline=False, op='symlink',
+                  src='a', dst='b')
+        utils.log('[SKIPPED]')
+
+        event, = self.emitted()
+        self.assertEqual(('op', 'symlink', 'a', 'b', 'Default', 'skipped'),
+                         (event['event'], event['op'], event['src'],
+                          event['dst'], event['bundle'], event['result']))
+
+    def test_operation_that_raised_is_failed(self):
+        utils.log("Removing symlink 'b'", newline=False, op='remove',
+                  dst='b')
+        events.summary('unlink', 1)
+
+        op, summary = self.emitted()
+        self.assertEqual('failed', op['result'])
+        self.assertEqual({'remove': {'failed': 1}}, summary['counts'])
+        self.assertFalse(summary['ok'])
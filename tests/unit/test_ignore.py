@@ -0,0 +1,59 @@
+import unittest
+
+from homefiles import ignore
+
+
+class IgnoreRulesTestCase(unittest.TestCase):
+    def assertIgnored(self, patterns, relpath, is_dir=False):
+        rules = ignore.IgnoreRules.from_patterns(patterns)
+        self.assertTrue(rules.match(relpath, is_dir=is_dir))
+
+    def assertNotIgnored(self, patterns, relpath, is_dir=False):
+        rules = ignore.IgnoreRules.from_patterns(patterns)
+        self.assertFalse(rules.match(relpath, is_dir=is_dir))
+
+    def test_no_patterns(self):
+        self.assertNotIgnored([], '.vimrc')
+
+    def test_unanchored_matches_any_depth(self):
+        self.assertIgnored(['*.swp'], '.vimrc.swp')
+        self.assertIgnored(['*.swp'], '.vim/plugin/foo.swp')
+
+    def test_wildcard_does_not_cross_directories(self):
+        self.assertNotIgnored(['/bin/*.sh'], 'bin/sub/foo.sh')
+        self.assertIgnored(['/bin/**/*.sh'], 'bin/sub/foo.sh')
+
+    def test_anchored(self):
+        self.assertIgnored(['/scratch'], 'scratch')
+        self.assertNotIgnored(['/scratch'], 'bin/scratch')
+        self.assertIgnored(['bin/scratch'], 'bin/scratch')
+
+    def test_directory_only(self):
+        self.assertIgnored(['build/'], 'src/build', is_dir=True)
+        self.assertNotIgnored(['build/'], 'src/build')
+
+    def test_negation(self):
+        patterns = ['*.log', '!keep.log']
+        self.assertIgnored(patterns, 'debug.log')
+        self.assertNotIgnored(patterns, 'keep.log')
+
+    def test_last_match_wins(self):
+        self.assertIgnored(['!keep.log', '*.log'], 'keep.log')
+
+    def test_comments_and_blank_lines(self):
+        self.assertNotIgnored(['# foo', '', '\\#foo'], 'foo')
+        self.assertIgnored(['# foo', '', '\\#foo'], '#foo')
+
+    def test_ignores_path_checks_parents(self):
+        rules = ignore.IgnoreRules.from_patterns(['node_modules/'])
+        self.assertTrue(rules.ignores_path('.config/node_modules/x/y.js'))
+        self.assertFalse(rules.ignores_path('.config/app/y.js'))
+
+    def test_more_patterns_than_regex_groups(self):
+        patterns = ['*.log'] + ['/file%d' % i for i in range(150)] + \
+            ['!keep.log']
+        self.assertIgnored(patterns, 'file0')
+        self.assertIgnored(patterns, 'file149')
+        self.assertIgnored(patterns, 'debug.log')
+        self.assertNotIgnored(patterns, 'keep.log')
+        self.assertNotIgnored(patterns, 'file150')
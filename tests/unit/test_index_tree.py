@@ -0,0 +1,39 @@
+import unittest
+
+import homefiles
+
+
+class IndexTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        paths = ['Default/.bashrc', 'Default/.vim/.trackeddir',
+                 'Default/.vim/plugin/foo.vim', 'Default/bin/a.sh',
+                 'OS-Linux/.bashrc']
+        self.tree = homefiles.IndexTree('/repo', lambda: paths)
+
+    def walk(self, top, **kwargs):
+        return list(self.tree.walk(top, **kwargs))
+
+    def test_walk_bundle(self):
+        self.assertEqual(
+            [('/repo/Default', ['.vim', 'bin'], ['.bashrc']),
+             ('/repo/Default/.vim', ['plugin'], ['.trackeddir']),
+             ('/repo/Default/.vim/plugin', [], ['foo.vim']),
+             ('/repo/Default/bin', [], ['a.sh'])],
+            self.walk('/repo/Default'))
+
+    def test_prune_keeps_dirname(self):
+        walked = self.walk('/repo/Default',
+                           prune=lambda path: path.endswith('/.vim'))
+        self.assertEqual(['/repo/Default', '/repo/Default/bin'],
+                         [dirpath for dirpath, dirnames, filenames in walked])
+        self.assertEqual(['.vim', 'bin'], walked[0][1])
+
+    def test_skip(self):
+        walked = self.walk('/repo/Default',
+                           skip=lambda path, is_dir: not is_dir)
+        self.assertEqual([[], [], [], []],
+                         [filenames
+                          for dirpath, dirnames, filenames in walked])
+
+    def test_missing_top(self):
+        self.assertEqual([], self.walk('/repo/Laptop'))
@@ -0,0 +1,49 @@
+import unittest
+
+import homefiles
+
+
+class OverlayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.overlay = homefiles.Overlay([
+            ('symlink', '/repo/OS-Linux/.bashrc', '.bashrc', 'OS-Linux'),
+            ('directory', '/repo/OS-Linux/bin', 'bin', 'OS-Linux'),
+            ('symlink', '/repo/OS-Linux/bin/b.sh', 'bin/b.sh', 'OS-Linux'),
+            ('symlink', '/repo/OS-Linux/foo', 'foo', 'OS-Linux'),
+            ('symlink', '/repo/Default/.bashrc', '.bashrc', 'Default'),
+            ('directory', '/repo/Default/bin', 'bin', 'Default'),
+            ('symlink', '/repo/Default/bin/a.sh', 'bin/a.sh', 'Default'),
+            ('directory', '/repo/Default/foo', 'foo', 'Default'),
+            ('symlink', '/repo/Default/foo/x', 'foo/x', 'Default'),
+            ('symlink', '/repo/Default/.vim', '.vim', 'Default'),
+        ])
+
+    def test_entries_are_winners_in_order(self):
+        self.assertEqual(
+            [('symlink', '/repo/OS-Linux/.bashrc', '.bashrc', 'OS-Linux'),
+             ('symlink', '/repo/Default/.vim', '.vim', 'Default'),
+             ('directory', '/repo/OS-Linux/bin', 'bin', 'OS-Linux'),
+             ('symlink', '/repo/Default/bin/a.sh', 'bin/a.sh', 'Default'),
+             ('symlink', '/repo/OS-Linux/bin/b.sh', 'bin/b.sh', 'OS-Linux'),
+             ('symlink', '/repo/OS-Linux/foo', 'foo', 'OS-Linux')],
+            list(self.overlay.entries()))
+
+    def test_shadowed(self):
+        node = self.overlay.find('.bashrc')
+        self.assertEqual('OS-Linux', node.bundle)
+        self.assertEqual([('symlink', '/repo/Default/.bashrc', 'Default')],
+                         node.shadowed)
+
+    def test_directories_are_merged(self):
+        node = self.overlay.find('bin')
+        self.assertEqual([], node.shadowed)
+        self.assertEqual(['OS-Linux', 'Default'],
+                         [bundle for kind, source, bundle in node.suppliers])
+
+    def test_find_beneath_linked_directory(self):
+        node = self.overlay.find('.vim/plugin/p.vim')
+        self.assertEqual('.vim', node.relpath)
+
+    def test_find_missing(self):
+        self.assertEqual(None, self.overlay.find('nope'))
+        self.assertEqual(None, self.overlay.find('nope/deeper'))
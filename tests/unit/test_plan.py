@@ -0,0 +1,255 @@
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+
+import homefiles
+from homefiles import git
+from homefiles import plan
+from homefiles import utils
+
+from test_relink import GitTestCase
+from test_relink import run_git
+
+
+class PlanBackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.root = os.path.join(self.tmpdir, 'root')
+        self.backup = os.path.join(self.tmpdir, 'backup')
+        os.makedirs(os.path.join(self.root, '.vim'))
+
+    def describe(self, paths):
+        return [(op.kind, op.source, op.path) for op in
+                plan.plan_backup([os.path.join(self.root, p) for p in paths],
+                                 self.root, self.backup)]
+
+    def test_keeps_layout(self):
+        self.assertEqual(
+            [('mkdir', None, self.backup),
+             ('rename', os.path.join(self.root, '.bashrc'),
+              os.path.join(self.backup, '.bashrc')),
+             ('mkdir', None, os.path.join(self.backup, 'bin')),
+             ('rename', os.path.join(self.root, 'bin/a.sh'),
+              os.path.join(self.backup, 'bin/a.sh'))],
+            self.describe(['bin/a.sh', '.bashrc']))
+
+    def test_paths_beneath_another_move_with_it(self):
+        self.assertEqual(['mkdir', 'rename'],
+                         [kind for kind, source, path in
+                          self.describe(['.vim', '.vim/old'])])
+
+    def test_existing_backup_conflicts(self):
+        os.makedirs(os.path.join(self.backup, '.vim'))
+        self.assertEqual([('conflict', None, os.path.join(self.root, '.vim'))],
+                         self.describe(['.vim']))
+
+
+class LinkTestCase(GitTestCase):
+    def setUp(self):
+        super(LinkTestCase, self).setUp()
+        self.write('Default/.bashrc')
+        self.write('Default/bin/a.sh')
+
+    def make_homefiles(self, **kwargs):
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles',
+                                 **kwargs)
+        hf._platforms = ['OS-Linux']
+        return hf
+
+    def link_target(self, relpath):
+        return os.readlink(os.path.join(self.root, relpath))
+
+    def test_unlink_restores_root(self):
+        os.makedirs(os.path.join(self.root, 'bin'))
+        self.commit()
+        hf = self.make_homefiles()
+        hf.link()
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         self.link_target('bin/a.sh'))
+
+        hf.unlink()
+        self.assertEqual(['bin'], os.listdir(self.root))
+        self.assertEqual([], os.listdir(os.path.join(self.root, 'bin')))
+
+    def test_shadowed_link_is_retargeted(self):
+        self.commit()
+        self.make_homefiles().link()
+        self.write('OS-Linux/.bashrc')
+        self.commit()
+
+        hf = self.make_homefiles()
+        bundles, link_plan = hf.plan_link()
+        self.assertEqual(
+            [(plan.REPLACE, 'OS-Linux')],
+            [(op.kind, op.bundle) for op in link_plan
+             if op.path == os.path.join(self.root, '.bashrc')])
+
+        hf.link()
+        self.assertEqual(os.path.join(self.repo, 'OS-Linux/.bashrc'),
+                         self.link_target('.bashrc'))
+
+    def test_every_conflict_reported(self):
+        self.commit()
+        os.makedirs(os.path.join(self.root, 'bin'))
+        for relpath in ('.bashrc', 'bin/a.sh'):
+            with open(os.path.join(self.root, relpath), 'w') as f:
+                f.write('mine')
+
+        try:
+            self.make_homefiles().link()
+        except homefiles.Conflicts as e:
+            self.assertEqual([os.path.join(self.root, '.bashrc'),
+                              os.path.join(self.root, 'bin/a.sh')],
+                             sorted(e.paths))
+        else:
+            self.fail('Conflicts not raised')
+
+        self.assertEqual(['.bashrc', 'bin'], sorted(os.listdir(self.root)))
+        self.assertFalse(os.path.islink(os.path.join(self.root, 'bin/a.sh')))
+
+    def test_collapsed_directory_split(self):
+        self.commit()
+        self.make_homefiles(collapse_directories=True).link()
+        self.assertEqual(os.path.join(self.repo, 'Default/bin'),
+                         self.link_target('bin'))
+
+        self.write('OS-Linux/bin/b.sh')
+        self.commit()
+        self.make_homefiles(collapse_directories=True).link()
+        self.assertFalse(os.path.islink(os.path.join(self.root, 'bin')))
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         self.link_target('bin/a.sh'))
+        self.assertEqual(os.path.join(self.repo, 'OS-Linux/bin/b.sh'),
+                         self.link_target('bin/b.sh'))
+
+
+class TrackTestCase(GitTestCase):
+    def setUp(self):
+        super(TrackTestCase, self).setUp()
+        run_git(self.repo, 'config', 'user.name', 't')
+        run_git(self.repo, 'config', 'user.email', 't@t')
+        self.write('Default/.profile')
+        self.head = self.commit()
+        for relpath in ('.bashrc', '.config/fish/a.fish',
+                        '.config/fish/b.fish', '.vim/plugin/p.vim'):
+            self.write_root(relpath, relpath)
+
+        self.homefiles = homefiles.Homefiles(self.root, self.repo,
+                                             '.homefiles')
+        self.homefiles._platforms = []
+        self.git_calls = []
+        for name in ('add', 'commit'):
+            self.count_calls(name)
+
+    def count_calls(self, name):
+        method = getattr(self.homefiles.git, name)
+
+        def wrapper(*args, **kwargs):
+            self.git_calls.append(name)
+            return method(*args, **kwargs)
+        setattr(self.homefiles.git, name, wrapper)
+
+    def write_root(self, relpath, data):
+        path = os.path.join(self.root, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def root_path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def assertUntouched(self, tracked=('.profile',)):
+        self.assertEqual(self.head, git.GitRepo(self.repo).head_commit())
+        self.assertEqual(sorted(tracked),
+                         sorted(os.listdir(os.path.join(self.repo,
+                                                        'Default'))))
+        for relpath in ('.bashrc', '.vim/plugin/p.vim'):
+            self.assertFalse(os.path.islink(self.root_path(relpath)))
+            with open(self.root_path(relpath)) as f:
+                self.assertEqual(relpath, f.read())
+
+    def test_batch(self):
+        self.homefiles.track([self.root_path('.bashrc'),
+                              self.root_path('.config/fish/*.fish'),
+                              self.root_path('.vim'),
+                              self.root_path('.vim/plugin/p.vim')])
+
+        for relpath in ('.bashrc', '.config/fish/a.fish',
+                        '.config/fish/b.fish', '.vim'):
+            self.assertEqual(os.path.join(self.repo, 'Default', relpath),
+                             os.readlink(self.root_path(relpath)))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.repo, 'Default/.vim/.trackeddir')))
+        self.assertEqual(['add', 'commit'], self.git_calls)
+        self.assertEqual({}, git.GitRepo(self.repo).uncommitted_paths())
+
+    def test_already_tracked_changes_nothing(self):
+        self.write('Default/.vim/plugin/p.vim')
+        self.assertRaises(homefiles.AlreadyTracked, self.homefiles.track,
+                          [self.root_path('.bashrc'), self.root_path('.vim')])
+        self.assertUntouched(tracked=['.profile', '.vim'])
+        self.assertEqual([], self.git_calls)
+
+    def test_failure_rolls_back_batch(self):
+        symlinks = []
+        self.addCleanup(setattr, utils, 'symlink', utils.symlink)
+        symlink = utils.symlink
+
+        def failing_symlink(*args, **kwargs):
+            symlinks.append(args)
+            if len(symlinks) == 2:
+                raise OSError(errno.EACCES, 'Permission denied')
+            return symlink(*args, **kwargs)
+
+        utils.symlink = failing_symlink
+        self.assertRaises(OSError, self.homefiles.track,
+                          [self.root_path('.bashrc'), self.root_path('.vim')])
+        self.assertUntouched()
+        self.assertEqual([], self.git_calls)
+
+
+class FleetTestCase(GitTestCase):
+    def setUp(self):
+        super(FleetTestCase, self).setUp()
+        self.write('Default/.bashrc')
+        self.write('Default/bin/a.sh')
+        self.commit()
+        self.roots = [os.path.join(self.tmpdir, name)
+                      for name in ('alice', 'bob')]
+        for root in self.roots:
+            os.makedirs(root)
+        self.blocking = os.path.join(self.roots[1], '.bashrc')
+        with open(self.blocking, 'w') as f:
+            f.write('mine')
+
+        self.homefiles = homefiles.Homefiles(self.root, self.repo,
+                                             '.homefiles')
+        self.homefiles._platforms = []
+
+    def test_failed_root_is_left_alone(self):
+        alice, bob = self.roots
+        results = self.homefiles.link(roots=self.roots, jobs=2)
+        self.assertEqual([alice, bob], [root for root, error in results])
+        self.assertIsNone(results[0][1])
+        self.assertTrue(isinstance(results[1][1], homefiles.NotASymlink))
+
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         os.readlink(os.path.join(alice, 'bin/a.sh')))
+        self.assertEqual(['.bashrc'], os.listdir(bob))
+        self.assertEqual(
+            sorted(os.path.join(alice, p) for p in ('.bashrc', 'bin',
+                                                    'bin/a.sh')),
+            sorted(path for bundle, kind, path in
+                   self.homefiles.manifest.read(alice)))
+        self.assertEqual([], self.homefiles.manifest.read(bob))
+
+        results = self.homefiles.unlink(roots=self.roots, jobs=2)
+        self.assertEqual([(alice, None), (bob, None)], results)
+        self.assertEqual([], os.listdir(alice))
+        self.assertEqual(['.bashrc'], os.listdir(bob))
+        with open(self.blocking) as f:
+            self.assertEqual('mine', f.read())
@@ -0,0 +1,200 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import homefiles
+from homefiles import git
+from homefiles import utils
+
+
+def run_git(repo_path, *args):
+    subprocess.check_call(
+        ['git', '-c', 'user.name=t', '-c', 'user.email=t@t'] + list(args),
+        cwd=repo_path, stdout=open(os.devnull, 'w'))
+
+
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        self.root = os.path.join(self.tmpdir, 'root')
+        os.makedirs(self.repo)
+        os.makedirs(self.root)
+        run_git(self.repo, 'init', '-q', '.')
+
+    def write(self, relpath, data='x'):
+        path = os.path.join(self.repo, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def commit(self):
+        run_git(self.repo, 'add', '-A')
+        run_git(self.repo, 'commit', '-q', '-m', 'commit')
+        return git.GitRepo(self.repo).head_commit()
+
+
+class ChangedPathsTestCase(GitTestCase):
+    def test_added_removed_modified(self):
+        self.write('Default/.bashrc')
+        self.write('Default/.vimrc')
+        self.write('Default/old')
+        old = self.commit()
+
+        self.write('Default/.bashrc', 'changed')
+        os.unlink(os.path.join(self.repo, 'Default/.vimrc'))
+        self.write('OS-Linux/.vimrc')
+        run_git(self.repo, 'mv', 'Default/old', 'Default/new')
+        new = self.commit()
+
+        added, removed, modified = git.GitRepo(self.repo).changed_paths(
+            old, new)
+        self.assertEqual(set(['OS-Linux/.vimrc', 'Default/new']), added)
+        self.assertEqual(set(['Default/.vimrc', 'Default/old']), removed)
+        self.assertEqual(set(['Default/.bashrc']), modified)
+
+    def test_same_commit(self):
+        self.write('Default/.bashrc')
+        commit = self.commit()
+        self.assertEqual((set(), set(), set()),
+                         git.GitRepo(self.repo).changed_paths(commit, commit))
+
+
+class RelinkChangesTestCase(GitTestCase):
+    def setUp(self):
+        super(RelinkChangesTestCase, self).setUp()
+        self.write('Default/.bashrc')
+        self.write('OS-Linux/.bashrc')
+        self.write('Custom/.config/custom/c.conf')
+        self.commit()
+        self.homefiles = self.make_homefiles()
+        self.homefiles.link(selected=['Custom'])
+
+    def make_homefiles(self):
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles')
+        hf._platforms = ['OS-Linux']
+        return hf
+
+    def link_target(self, relpath):
+        return os.readlink(os.path.join(self.root, relpath))
+
+    def test_added(self):
+        self.write('Default/bin/a.sh')
+        self.homefiles._relink_changes(set(['Default/bin/a.sh']), set())
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         self.link_target('bin/a.sh'))
+
+    def test_removed_falls_back_to_less_specific_bundle(self):
+        os.unlink(os.path.join(self.repo, 'OS-Linux/.bashrc'))
+        self.homefiles._relink_changes(set(), set(['OS-Linux/.bashrc']))
+        self.assertEqual(os.path.join(self.repo, 'Default/.bashrc'),
+                         self.link_target('.bashrc'))
+
+    def test_fallback_never_removes_link(self):
+        removed = []
+        self.addCleanup(setattr, utils, 'remove_symlink',
+                        utils.remove_symlink)
+        utils.remove_symlink = lambda path, **kwargs: removed.append(path)
+
+        os.unlink(os.path.join(self.repo, 'OS-Linux/.bashrc'))
+        self.homefiles._relink_changes(set(), set(['OS-Linux/.bashrc']))
+        self.assertEqual([], removed)
+        self.assertEqual(os.path.join(self.repo, 'Default/.bashrc'),
+                         self.link_target('.bashrc'))
+
+    def test_conflicts_reported_before_changes(self):
+        self.write('Default/.a')
+        self.write('Default/.b')
+        os.unlink(os.path.join(self.repo, 'OS-Linux/.bashrc'))
+        for name in ('.a', '.b'):
+            with open(os.path.join(self.root, name), 'w') as f:
+                f.write('mine')
+
+        try:
+            self.homefiles._relink_changes(
+                set(['Default/.a', 'Default/.b']),
+                set(['OS-Linux/.bashrc']))
+        except homefiles.Conflicts as e:
+            self.assertEqual([os.path.join(self.root, '.a'),
+                              os.path.join(self.root, '.b')], e.paths)
+        else:
+            self.fail('Conflicts not raised')
+
+        self.assertEqual(os.path.join(self.repo, 'OS-Linux/.bashrc'),
+                         self.link_target('.bashrc'))
+
+    def test_removed_custom_bundle(self):
+        shutil.rmtree(os.path.join(self.repo, 'Custom'))
+        hf = self.make_homefiles()
+        hf._relink_changes(set(), set(['Custom/.config/custom/c.conf']))
+        self.assertFalse(os.path.lexists(
+            os.path.join(self.root, '.config/custom/c.conf')))
+        self.assertFalse(os.path.lexists(os.path.join(self.root, '.config')))
+
+
+class TrackedDirectoryTestCase(GitTestCase):
+    def test_uncommitted_marker(self):
+        self.write('Default/.bashrc')
+        self.commit()
+        self.write('Default/.notes/todo')
+        self.write('Default/.notes/.trackeddir', '')
+
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles')
+        hf._platforms = []
+        hf.link()
+        self.assertEqual(os.path.join(self.repo, 'Default/.notes'),
+                         os.readlink(os.path.join(self.root, '.notes')))
+
+    def test_removed_marker(self):
+        self.write('Default/.notes/todo')
+        self.write('Default/.notes/.trackeddir', '')
+        self.commit()
+        os.unlink(os.path.join(self.repo, 'Default/.notes/.trackeddir'))
+
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles')
+        hf._platforms = []
+        hf.link()
+        self.assertEqual(os.path.join(self.repo, 'Default/.notes/todo'),
+                         os.readlink(os.path.join(self.root, '.notes/todo')))
+
+
+class RelinkDeployedTestCase(GitTestCase):
+    def setUp(self):
+        super(RelinkDeployedTestCase, self).setUp()
+        self.write('.homefilesdeploy', 'copy .config/\n')
+        self.write('Default/.bashrc')
+        self.write('Default/.config/app.json', 'old')
+        self.commit()
+        self.homefiles = homefiles.Homefiles(self.root, self.repo,
+                                             '.homefiles')
+        self.homefiles._platforms = []
+        self.homefiles.link()
+
+    def read_root(self, relpath):
+        with open(os.path.join(self.root, relpath)) as f:
+            return f.read()
+
+    def test_incremental_with_copies(self):
+        def reconcile(linked):
+            self.fail('reconciled everything')
+
+        self.homefiles._reconcile = reconcile
+        self.write('Default/bin/a.sh')
+        self.write('Default/.config/app.json', 'new')
+        self.homefiles.relink_paths(set(['Default/bin/a.sh']), set(),
+                                    set(['Default/.config/app.json']))
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         os.readlink(os.path.join(self.root, 'bin/a.sh')))
+        self.assertEqual('new', self.read_root('.config/app.json'))
+
+    def test_added_copy(self):
+        self.write('Default/.config/other.json', 'other')
+        self.homefiles.relink_paths(set(['Default/.config/other.json']),
+                                    set())
+        path = os.path.join(self.root, '.config/other.json')
+        self.assertFalse(os.path.islink(path))
+        self.assertEqual('other', self.read_root('.config/other.json'))
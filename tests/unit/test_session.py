@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import homefiles
+from homefiles import session
+
+from test_relink import GitTestCase
+
+
+class SessionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.repo = os.path.join(self.tmpdir, 'repo')
+        os.makedirs(os.path.join(self.repo, '.git'))
+        self.session = session.Session(
+            root_path=os.path.join(self.tmpdir, 'root'),
+            repo_path=self.repo, remote_repo='.homefiles')
+
+    def test_caches_kept_while_repo_unchanged(self):
+        rules = self.session.homefiles.ignore_rules
+        self.session._refresh()
+        self.assertTrue(self.session.homefiles.ignore_rules is rules)
+
+    def test_caches_dropped_when_repo_changes(self):
+        rules = self.session.homefiles.ignore_rules
+        with open(os.path.join(self.repo, '.homefilesignore'), 'w') as f:
+            f.write('*.swp\n')
+        self.session._refresh()
+        self.assertFalse(self.session.homefiles.ignore_rules is rules)
+
+    def test_failures_are_homefiles_exceptions(self):
+        shutil.rmtree(self.repo)
+        self.assertRaises(homefiles.FilesystemError, self.session.bundles)
+
+    def test_platforms_dropped_when_release_files_change(self):
+        hf = self.session.homefiles
+        hf._platforms = ['OS-Old']
+        hf.platform_state.key = lambda: 'changed'
+        self.session._refresh()
+        self.assertEqual(None, hf._platforms)
+
+
+class SessionLinkTestCase(GitTestCase):
+    def test_new_tracked_directory_marker(self):
+        self.write('Default/.vim/vimrc')
+        self.commit()
+        s = session.Session(root_path=self.root, repo_path=self.repo,
+                            remote_repo='.homefiles')
+        s.homefiles._platforms = []
+        s.link()
+        s.unlink()
+
+        self.write('Default/.vim/.trackeddir', '')
+        s.link()
+        self.assertEqual(os.path.join(self.repo, 'Default/.vim'),
+                         os.readlink(os.path.join(self.root, '.vim')))
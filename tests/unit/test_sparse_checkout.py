@@ -0,0 +1,39 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import homefiles
+
+
+class SparseCheckoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        os.makedirs(os.path.join(self.tmpdir, '.git', 'info'))
+        self.enabled = True
+
+    def write(self, lines):
+        path = os.path.join(self.tmpdir, '.git', 'info', 'sparse-checkout')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def bundles(self):
+        sparse = homefiles.SparseCheckout(self.tmpdir, lambda: self.enabled)
+        return sparse.bundles()
+
+    def test_no_file(self):
+        self.assertIsNone(self.bundles())
+
+    def test_cone(self):
+        self.write(['/*', '!/*/', '/Default/', '/OS-Linux/'])
+        self.assertEqual(['Default', 'OS-Linux'], self.bundles())
+
+    def test_disabled(self):
+        self.write(['/*', '!/*/', '/Default/'])
+        self.enabled = False
+        self.assertIsNone(self.bundles())
+
+    def test_not_cone(self):
+        self.write(['/Default/', '*.swp'])
+        self.assertIsNone(self.bundles())
@@ -0,0 +1,70 @@
+import os
+
+import homefiles
+
+from test_relink import GitTestCase
+
+
+class StatusTestCase(GitTestCase):
+    def setUp(self):
+        super(StatusTestCase, self).setUp()
+        self.write('Default/.bashrc')
+        self.write('Default/bin/a.sh')
+        self.commit()
+        self.homefiles = self.make_homefiles()
+        self.homefiles.link()
+
+    def make_homefiles(self):
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles')
+        hf._platforms = []
+        return hf
+
+    def status(self, planned=False):
+        hf = self.make_homefiles()
+
+        def check_plan(status):
+            self.fail('planned a link')
+
+        if not planned:
+            hf._check_plan = check_plan
+        return hf.status()
+
+    def test_consistent_from_manifest(self):
+        self.assertTrue(self.status().consistent)
+
+    def test_missing_and_blocked_from_manifest(self):
+        os.unlink(os.path.join(self.root, '.bashrc'))
+        os.unlink(os.path.join(self.root, 'bin/a.sh'))
+        with open(os.path.join(self.root, 'bin/a.sh'), 'w') as f:
+            f.write('mine')
+
+        status = self.status()
+        self.assertEqual([os.path.join(self.root, '.bashrc')], status.missing)
+        self.assertEqual([os.path.join(self.root, 'bin/a.sh')],
+                         status.blocked)
+
+    def test_wrong_target_from_manifest(self):
+        path = os.path.join(self.root, '.bashrc')
+        os.unlink(path)
+        os.symlink('/nowhere', path)
+
+        status = self.status()
+        expected = os.path.join(self.repo, 'Default/.bashrc')
+        self.assertEqual([(path, '/nowhere', expected)], status.wrong_target)
+        self.assertEqual([(path, '/nowhere')], status.broken)
+
+    def test_deleted_source_is_broken(self):
+        source = os.path.join(self.repo, 'Default/.bashrc')
+        os.unlink(source)
+
+        status = self.status()
+        self.assertEqual([(os.path.join(self.root, '.bashrc'), source)],
+                         status.broken)
+        self.assertTrue(status.uncommitted_changes)
+
+    def test_plans_once_head_moves(self):
+        self.write('Default/.vimrc')
+        self.commit()
+
+        status = self.status(planned=True)
+        self.assertEqual([os.path.join(self.root, '.vimrc')], status.missing)
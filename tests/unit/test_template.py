@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import homefiles
+from homefiles import template
+
+from test_relink import GitTestCase
+
+
+class RenderTestCase(unittest.TestCase):
+    def test_substitutes_variables(self):
+        self.assertEqual('email = me@example.com\n',
+                         template.render('email = {{ email }}\n',
+                                         {'email': 'me@example.com'}))
+
+    def test_leaves_shell_variables_alone(self):
+        text = 'f() { echo $1 ${HOME}; }'
+        self.assertEqual(text, template.render(text, {}))
+
+    def test_undefined_variable(self):
+        self.assertRaises(template.TemplateError, template.render,
+                          '{{ email }}', {})
+
+
+class ReadVariablesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, template.VARS_FILENAME)
+        with open(self.path, 'w') as f:
+            f.write('[DEFAULT]\n'
+                    'Email = me@example.com\n'
+                    'editor = vim\n'
+                    '\n'
+                    '[worklaptop]\n'
+                    'Email = me@example.org\n')
+
+    def test_host_section_overrides_defaults(self):
+        self.assertEqual({'Email': 'me@example.org', 'editor': 'vim'},
+                         template.read_variables(self.path, 'worklaptop'))
+
+    def test_other_hosts_get_defaults(self):
+        self.assertEqual({'Email': 'me@example.com', 'editor': 'vim'},
+                         template.read_variables(self.path, 'desktop'))
+
+
+class WalkedLinksTestCase(GitTestCase):
+    def test_other_hosts_templates_not_rendered(self):
+        self.write('Default/.bashrc')
+        self.write('OS-Darwin/.gitconfig.hftmpl', 'email = {{ work_email }}')
+        self.commit()
+        hf = homefiles.Homefiles(self.root, self.repo, '.homefiles')
+        hf._platforms = ['OS-Linux']
+        hf.link()
+        # As for a repo linked before the manifest existed
+        hf.manifest.clear()
+
+        hf.unlink()
+        self.assertEqual([], os.listdir(self.root))
+        self.assertFalse(os.path.exists(hf.templates.cache_path))
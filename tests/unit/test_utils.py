@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 import unittest
 
 from homefiles import utils
@@ -15,3 +18,61 @@ class CapitalizeFirstLetterTestCase(unittest.TestCase):
 
     def test_mixed_case(self):
         self.assertCapitalization('FooBaR', 'fooBaR')
+
+
+class StatCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_caches_missing_path(self):
+        path = os.path.join(self.tmpdir, 'foo')
+        with utils.stat_cache():
+            self.assertFalse(utils.lexists(path))
+            open(path, 'w').close()
+            self.assertFalse(utils.lexists(path))
+        self.assertTrue(utils.lexists(path))
+
+    def test_helpers_update_cache(self):
+        source = os.path.join(self.tmpdir, 'source')
+        link_name = os.path.join(self.tmpdir, 'link')
+        with utils.stat_cache():
+            self.assertFalse(utils.lexists(link_name))
+            self.assertTrue(utils.symlink(source, link_name))
+            self.assertTrue(utils.islink(link_name))
+            utils.remove_symlink(link_name)
+            self.assertFalse(utils.lexists(link_name))
+
+    def test_removing_link_forgets_paths_beneath_it(self):
+        target = os.path.join(self.tmpdir, 'target')
+        os.mkdir(target)
+        open(os.path.join(target, 'foo'), 'w').close()
+        link_name = os.path.join(self.tmpdir, 'link')
+        os.symlink(target, link_name)
+        with utils.stat_cache():
+            self.assertTrue(utils.lexists(os.path.join(link_name, 'foo')))
+            utils.remove_symlink(link_name)
+            self.assertFalse(utils.lexists(os.path.join(link_name, 'foo')))
+
+
+class ReplaceSymlinkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.link_name = os.path.join(self.tmpdir, 'link')
+
+    def test_retargets_and_undoes(self):
+        os.symlink('old', self.link_name)
+        undo_log = []
+        self.assertTrue(utils.replace_symlink('new', self.link_name,
+                                              undo_log=undo_log))
+        self.assertEqual('new', os.readlink(self.link_name))
+        self.assertEqual(['link'], os.listdir(self.tmpdir))
+
+        utils.undo_operations(undo_log)
+        self.assertEqual('old', os.readlink(self.link_name))
+
+    def test_refuses_regular_file(self):
+        open(self.link_name, 'w').close()
+        self.assertRaises(utils.NotASymlink, utils.replace_symlink, 'new',
+                          self.link_name)
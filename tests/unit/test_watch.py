@@ -0,0 +1,67 @@
+import os
+
+import homefiles
+from homefiles import git
+from homefiles import utils
+from homefiles import watch
+
+from test_relink import GitTestCase
+from test_relink import run_git
+
+
+class WatcherTestCase(GitTestCase):
+    def setUp(self):
+        super(WatcherTestCase, self).setUp()
+        run_git(self.repo, 'config', 'user.name', 't')
+        run_git(self.repo, 'config', 'user.email', 't@t')
+        self.write('Default/.bashrc')
+        self.head = self.commit()
+
+        self.homefiles = homefiles.Homefiles(self.root, self.repo,
+                                             '.homefiles')
+        self.homefiles._platforms = []
+        self.homefiles.link()
+
+        self.watcher = watch.Watcher(self.homefiles, debounce=0)
+        git_dir = os.path.join(self.repo, '.git')
+        self.watcher.source = watch.PollingSource(
+            self.repo, lambda path, is_dir: path == git_dir, interval=0)
+
+    def head_commit(self):
+        return git.GitRepo(self.repo).head_commit()
+
+    def settle(self):
+        self.watcher.handle(self.watcher.source.wait(0))
+        self.watcher.commit()
+
+    def test_added_file_is_linked(self):
+        self.write('Default/bin/a.sh')
+        self.settle()
+        self.assertEqual(os.path.join(self.repo, 'Default/bin/a.sh'),
+                         os.readlink(os.path.join(self.root, 'bin/a.sh')))
+
+    def test_edit_is_committed(self):
+        self.write('Default/.bashrc', 'changed')
+        self.settle()
+        self.assertNotEqual(self.head, self.head_commit())
+        self.assertEqual({}, git.GitRepo(self.repo).uncommitted_paths())
+
+    def test_touch_is_not_committed(self):
+        path = os.path.join(self.repo, 'Default/.bashrc')
+        os.utime(path, (1000000000, 1000000000))
+        self.settle()
+        self.assertEqual(self.head, self.head_commit())
+
+    def test_git_failure_is_reported(self):
+        errors = []
+        self.addCleanup(setattr, utils, 'error', utils.error)
+        utils.error = errors.append
+
+        def commit(**kwargs):
+            raise git.ProcessException(1, '', 'failed')
+
+        self.homefiles.git.commit = commit
+        self.write('Default/.bashrc', 'changed')
+        self.settle()
+        self.assertEqual(1, len(errors))
+        self.assertEqual(self.head, self.head_commit())